@@ -13,7 +13,6 @@ python3 -m venv /opt/xuim/venv
 
 echo "📦 Installing Python dependencies inside venv..."
 /opt/xuim/venv/bin/pip install --upgrade pip
-/opt/xuim/venv/bin/pip install tabulate
 
 chmod +x /opt/xuim/xuim.py
 chmod +x /opt/xuim/uninstall.sh
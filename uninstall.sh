@@ -3,6 +3,7 @@ set -e
 
 INSTALL_DIR="/opt/xuim"
 BIN_FILE="/usr/bin/xuim"
+CACHE_DIR="${XUIM_CACHE_DIR:-/var/cache/xuim}"
 
 echo "Uninstalling X-UI Management Tool..."
 
@@ -16,6 +17,13 @@ if [ -d "$INSTALL_DIR" ]; then
     rm -rf "$INSTALL_DIR"
 fi
 
+# Remove the client index cache (only our files, the directory only if empty)
+if [ -d "$CACHE_DIR" ]; then
+    rm -f "$CACHE_DIR"/index-*.db "$CACHE_DIR"/index-*.db-wal \
+        "$CACHE_DIR"/index-*.db-shm "$CACHE_DIR"/index-*.db-journal
+    rmdir "$CACHE_DIR" 2>/dev/null || true
+fi
+
 echo "Uninstallation completed."
 echo "You can install it with:"
 echo "bash <(curl -s https://raw.githubusercontent.com/7berlin/xuim-tool/main/install.sh)"
@@ -1,36 +1,587 @@
 import sqlite3
 import json
-import subprocess
+import hashlib
+import re
+import fnmatch
+import heapq
 import time
 import os
 import sys
-from tabulate import tabulate
+import threading
+from contextlib import contextmanager, nullcontext
+from itertools import chain, islice
 
 __version__ = "v1.0.0"
 DB_PATH = "/etc/x-ui/x-ui.db"
-now = int(time.time())
+BUSY_TIMEOUT_MS = int(os.environ.get("XUIM_BUSY_TIMEOUT_MS", "5000"))
+WRITE_RETRIES = int(os.environ.get("XUIM_WRITE_RETRIES", "5"))
+WRITE_BACKOFF = 0.2
+READ_ONLY = os.environ.get("XUIM_READ_ONLY", "") not in ("", "0")
+MMAP_SIZE = int(os.environ.get("XUIM_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.environ.get("XUIM_CACHE_SIZE_KB", "65536"))
+USAGE_CHUNK = 500
+CACHE_DIR = os.environ.get("XUIM_CACHE_DIR", "/var/cache/xuim")
+USE_INDEX = os.environ.get("XUIM_INDEX", "1") not in ("", "0")
+EXPORT_FLUSH_ROWS = int(os.environ.get("XUIM_EXPORT_FLUSH_ROWS", "1000"))
+CAS_RETRIES = int(os.environ.get("XUIM_CAS_RETRIES", "3"))
+DELETE_CHUNK_SIZE = int(os.environ.get("XUIM_DELETE_CHUNK_SIZE", "5000"))
+TABLE_FORMAT = os.environ.get("XUIM_TABLE_FORMAT", "grid")
+TABLE_SAMPLE_ROWS = 200
+SHOW_USAGE = os.environ.get("XUIM_SHOW_USAGE", "") not in ("", "0")
+PAGE_SIZE = int(os.environ.get("XUIM_PAGE_SIZE", "50"))
+DEBUG = bool(os.environ.get("XUIM_DEBUG"))
+GB = 1073741824
+DAY = 24 * 3600
+TRACE_SUMMARY = os.environ.get("XUIM_TRACE", "") in ("1", "summary")
+TRACE_FILE = os.environ.get("XUIM_TRACE") if not TRACE_SUMMARY else None
+CPROFILE_FILE = os.environ.get("XUIM_CPROFILE")
+BACKUP_DIR = os.environ.get("XUIM_BACKUP_DIR")
+BACKUP_KEEP = max(int(os.environ.get("XUIM_BACKUP_KEEP", "10")), 1)
+BACKUP_MAX_AGE_DAYS = int(os.environ.get("XUIM_BACKUP_MAX_AGE_DAYS", "0"))
+BACKUP_PAGES = int(os.environ.get("XUIM_BACKUP_PAGES", "256"))
+BACKUP_PAUSE = 0.002
+FLEET_WORKERS = int(os.environ.get("XUIM_WORKERS", "4"))
+DECODE_WORKERS = int(
+    os.environ.get("XUIM_DECODE_WORKERS", str(min(os.cpu_count() or 1, 8)))
+)
+PARALLEL_MIN_MB = int(os.environ.get("XUIM_PARALLEL_MIN_MB", "32"))
+AUTO_BACKUP = os.environ.get("XUIM_AUTO_BACKUP", "") not in ("", "0")
+COMPACT_AFTER = int(os.environ.get("XUIM_COMPACT_AFTER", "0"))
+JSON_SEPARATORS = (",", ":")
+JSON_BACKEND = os.environ.get("XUIM_JSON", "auto")
+
+
+def debug(msg):
+    if DEBUG:
+        print(f"\033[2m[debug] {msg}\033[0m", file=sys.stderr)
+
+
+# ------------------------- Tracing ------------------------- #
+class Trace:
+    """
+    Timings and counters for one user action (a CLI command or a menu entry).
+    Phases: sql, hash, json_decode, json_encode, filter, render, write_lock.
+    """
 
+    def __init__(self, action):
+        self.action = action
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
 
-# ------------------------- Database ------------------------- #
-def connect_db():
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        return {
+            "action": self.action,
+            "time": time.time(),
+            "wall_s": round(time.perf_counter() - self.started, 6),
+            "phases_s": {k: round(v, 6) for k, v in self.phases.items()},
+            "counters": self.counters,
+        }
+
+    def summary(self):
+        d = self.as_dict()
+        c = self.counters
+        phases = " | ".join(f"{k} {v:.3f}s" for k, v in d["phases_s"].items())
+        return (
+            f"[trace] {self.action}: {d['wall_s']:.3f}s\n"
+            f"  {phases or 'no phases'}\n"
+            f"  inbounds {c.get('inbounds_scanned', 0)}, "
+            f"clients {c.get('clients_scanned', 0)}, "
+            f"decoded {c.get('bytes_decoded', 0)} B, "
+            f"encoded {c.get('bytes_encoded', 0)} B, "
+            f"rows written {c.get('rows_written', 0)} "
+            f"({c.get('bytes_written', 0)} B, "
+            f"{c.get('rows_unchanged', 0)} unchanged skipped), "
+            f"write lock {c.get('write_lock_ms', 0):.1f} ms"
+        )
+
+
+TRACE = None
+NO_PHASE = nullcontext()
+
+
+def phase(name):
+    return TRACE.phase(name) if TRACE else NO_PHASE
+
+
+def count(name, n=1):
+    if TRACE:
+        TRACE.count(name, n)
+
+
+@contextmanager
+def traced(action):
+    """
+    Record one action when tracing is on: print a summary (XUIM_TRACE=1 or
+    --profile), append a JSON line (XUIM_TRACE=<file.jsonl> or --trace-file)
+    and/or dump cProfile stats (XUIM_CPROFILE=<file> or --cprofile).
+    Does nothing when all three are off.
+    """
+    global TRACE
+    if not (TRACE_SUMMARY or TRACE_FILE or CPROFILE_FILE) or TRACE is not None:
+        yield
+        return
+    import cProfile
+
+    TRACE = Trace(action)
+    profiler = cProfile.Profile() if CPROFILE_FILE else None
+    if profiler:
+        profiler.enable()
     try:
-        return sqlite3.connect(DB_PATH)
-    except Exception as e:
-        print(f"Cannot open database '{DB_PATH}': {e}")
-        sys.exit(1)
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(CPROFILE_FILE)
+        trace, TRACE = TRACE, None
+        if TRACE_SUMMARY:
+            print(trace.summary(), file=sys.stderr)
+        if TRACE_FILE:
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(json_dumps(trace.as_dict()) + "\n")
+
+
+# ------------------------- JSON Codec ------------------------- #
+def load_json_backend(name):
+    """orjson for XUIM_JSON=auto (when installed) or orjson, else None (stdlib)."""
+    if name not in ("auto", "orjson"):
+        return None
+    try:
+        import orjson
+    except ImportError:
+        if name == "orjson":
+            print("⚠️ XUIM_JSON=orjson but orjson is not installed, using json.")
+        return None
+    return orjson
+
+
+ORJSON = load_json_backend(JSON_BACKEND)
+
+
+def json_loads(text):
+    """
+    Parse JSON with the fastest backend. Documents orjson refuses (integers
+    beyond 64 bits, NaN) are parsed by the json module as before.
+    """
+    if ORJSON is not None:
+        try:
+            return ORJSON.loads(text)
+        except ORJSON.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+def json_dumps(obj, default=None):
+    """
+    Compact JSON, non-ASCII kept as is. orjson and the json module write
+    equivalent JSON (floats in exponent form are spelled differently, e.g.
+    1e16 vs 1e+16); what orjson cannot encode (huge integers, non-string keys,
+    lone surrogates) falls back to the json module.
+    """
+    if ORJSON is not None:
+        try:
+            return ORJSON.dumps(obj, default=default).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(
+        obj, ensure_ascii=False, separators=JSON_SEPARATORS, default=default
+    )
+
+
+def decode_clients(settings_json):
+    """
+    Lazy decoding for read-only reports: one (email, expiryTime, enable,
+    totalGB) tuple per client, built straight from the parsed array, which
+    is dropped before returning. Returns None when "clients" is not a list;
+    raises on invalid settings.
+    """
+    clients = decode_settings(settings_json).get("clients") or []
+    if not isinstance(clients, list):
+        return None
+    with phase("json_decode"):
+        return [
+            (
+                client_email(c),
+                c.get("expiryTime"),
+                c.get("enable", True),
+                c.get("totalGB"),
+            )
+            for c in clients
+        ]
+
+
+# ------------------------- Database ------------------------- #
+def is_locked_error(e):
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+
+def sqlite_uri(path, readonly=False):
+    path = os.path.abspath(path)
+    for char, escaped in (("%", "%25"), ("?", "%3f"), ("#", "%23")):
+        path = path.replace(char, escaped)
+    return "file:" + path + ("?mode=ro" if readonly else "")
+
+
+class Database:
+    """
+    Long-lived connections to one x-ui database.
+    reader: connection used by every report and export. It is opened with
+    mode=ro and PRAGMA query_only, so it can never take the write lock, and
+    reads through mmap with a larger page cache.
+    write(): BEGIN IMMEDIATE transaction with bounded retry and backoff,
+    recording how long the write lock was held.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._reader = None
+        self.journal_mode = None
+        self.last_lock_ms = 0.0
+        self.total_lock_ms = 0.0
+        self.snapshot = None
+        self.index = None
+        self.last_write = None
+
+    def _open(self, readonly=False):
+        try:
+            conn = sqlite3.connect(
+                sqlite_uri(self.path, readonly),
+                uri=True,
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,
+            )
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            if readonly:
+                conn.execute("PRAGMA query_only=1")
+                conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+                conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+            self.journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        except Exception as e:
+            print(f"Cannot open database '{self.path}': {e}")
+            sys.exit(1)
+        return conn
+
+    @property
+    def conn(self):
+        if READ_ONLY:
+            raise PermissionError("read-only mode (--read-only): no changes are made")
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = self._open(readonly=True)
+        return self._reader
+
+    def _begin(self):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_locked_error(e) or attempt == WRITE_RETRIES:
+                    raise
+                time.sleep(WRITE_BACKOFF * (2**attempt))
+
+    @contextmanager
+    def write(self):
+        self._begin()
+        started = time.perf_counter()
+        try:
+            yield self.conn.cursor()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.last_lock_ms = (time.perf_counter() - started) * 1000
+            self.total_lock_ms += self.last_lock_ms
+            count("write_lock_ms", self.last_lock_ms)
+            count("write_transactions")
+
+    def close(self):
+        for conn in (self._conn, self._reader):
+            if conn is not None:
+                conn.close()
+        self._conn = self._reader = None
+        if self.index is not None:
+            self.index.conn.close()
+            self.index = None
+
+
+_databases = {}
+# Per-thread state of fleet workers: db_path, output, collect.
+_local = threading.local()
+
+
+def current_db_path():
+    """DB_PATH, or the database a fleet worker thread is working on."""
+    return getattr(_local, "db_path", None) or DB_PATH
+
+
+def get_db():
+    path = current_db_path()
+    db = _databases.get(path)
+    if db is None:
+        db = _databases[path] = Database(path)
+    return db
+
+
+def fetch_inbounds(cursor, query, params=()):
+    with phase("sql"):
+        rows = cursor.execute(query, params).fetchall()
+    count("inbounds_scanned", len(rows))
+    return rows
+
+
+def decode_settings(settings_json):
+    with phase("json_decode"):
+        settings = json_loads(settings_json)
+    if TRACE:
+        TRACE.count("bytes_decoded", len(settings_json))
+        clients = settings.get("clients")
+        TRACE.count("clients_scanned", len(clients) if isinstance(clients, list) else 0)
+    return settings
+
+
+def encode_settings(settings):
+    """Compact JSON (no spaces after , and :), which x-ui parses the same."""
+    with phase("json_encode"):
+        settings_json = json_dumps(settings)
+    count("bytes_encoded", len(settings_json))
+    return settings_json
+
+
+def store_settings(cursor, inbound_id, settings_json, current=None):
+    """
+    UPDATE one inbound's settings unless they already are exactly
+    settings_json (current: the stored text, when the caller has read it).
+    Returns the number of bytes written, 0 when the row was left alone.
+    """
+    if settings_json == current:
+        count("rows_unchanged")
+        return 0
+    with phase("sql"):
+        cursor.execute(
+            "UPDATE inbounds SET settings=? WHERE id=?", (settings_json, inbound_id)
+        )
+    if not cursor.rowcount:
+        return 0
+    size = len(settings_json.encode("utf-8"))
+    count("rows_written")
+    count("bytes_written", size)
+    return size
+
+
+def write_settings(cursor, inbound_id, settings):
+    store_settings(cursor, inbound_id, encode_settings(settings))
 
 
 def list_inbounds():
-    conn = connect_db()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT id, remark, port FROM inbounds")
-        rows = cursor.fetchall()
+        return (
+            get_db().reader.execute("SELECT id, remark, port FROM inbounds").fetchall()
+        )
     except Exception as e:
         print(f"DB query failed: {e}")
-        rows = []
-    conn.close()
-    return rows
+        return []
+
+
+# ------------------------- Backups ------------------------- #
+def backup_dir():
+    if BACKUP_DIR:
+        return BACKUP_DIR
+    path = current_db_path()
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "xuim-backups")
+
+
+def list_backups():
+    """Backups as (path, size, mtime), newest first."""
+    directory = backup_dir()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in names:
+        if name.startswith("x-ui-") and name.endswith(".db"):
+            st = os.stat(os.path.join(directory, name))
+            backups.append((os.path.join(directory, name), st.st_size, st.st_mtime))
+    backups.sort(key=lambda b: (b[2], b[0]), reverse=True)
+    return backups
+
+
+def rotate_backups():
+    """Keep the newest BACKUP_KEEP backups, dropping any older than the age limit."""
+    cutoff = time.time() - BACKUP_MAX_AGE_DAYS * DAY if BACKUP_MAX_AGE_DAYS else 0
+    removed = []
+    for i, (path, _, mtime) in enumerate(list_backups()):
+        if i >= BACKUP_KEEP or (i > 0 and mtime < cutoff):
+            for leftover in (path, path + "-wal", path + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            removed.append(path)
+    debug(f"rotated out {len(removed)} backups")
+    return removed
+
+
+def create_backup(label="manual", rotate=True):
+    """
+    Copy the live database into the backup directory with SQLite's online
+    backup API. Pages are copied BACKUP_PAGES at a time with a short pause in
+    between so x-ui can keep writing; the file only gets its final name once
+    it is complete. Old backups are rotated out afterwards unless rotate=False.
+    Returns (path, size, elapsed_ms).
+    """
+    directory = backup_dir()
+    os.makedirs(directory, exist_ok=True)
+    label = re.sub(r"[^\w.-]+", "-", label).strip("-") or "backup"
+    base = os.path.join(directory, f"x-ui-{time.strftime('%Y%m%d-%H%M%S')}-{label}")
+    path, n = base + ".db", 1
+    while os.path.exists(path):
+        path, n = f"{base}-{n}.db", n + 1
+    part = path + ".part"
+
+    def pause(status, remaining, total):
+        if remaining:
+            time.sleep(BACKUP_PAUSE)
+
+    started = time.perf_counter()
+    target = sqlite3.connect(part)
+    try:
+        with phase("backup"):
+            get_db().reader.backup(target, pages=BACKUP_PAGES, progress=pause)
+        # A self-contained file: no -wal/-shm appear when it is opened later.
+        target.execute("PRAGMA journal_mode=DELETE")
+        target.close()
+        os.replace(part, path)
+    except BaseException:
+        target.close()
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    size = os.path.getsize(path)
+    count("backup_bytes", size)
+    print(f"💾 Backup {path} ({size / 1048576:.1f} MB) in {elapsed_ms:.0f} ms")
+    if rotate:
+        rotate_backups()
+    return path, size, elapsed_ms
+
+
+def auto_backup(label):
+    """Back up before a change when XUIM_AUTO_BACKUP / --backup is on."""
+    if AUTO_BACKUP:
+        create_backup(label)
+
+
+def restore_backup(path):
+    """
+    Replace the live database with a backup. The backup is checked first and
+    the current database is itself backed up, so a restore can be undone.
+    """
+    if not os.path.isfile(path):
+        path = os.path.join(backup_dir(), path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"no such backup: {os.path.basename(path)}")
+    source = sqlite3.connect(sqlite_uri(path, readonly=True), uri=True)
+    try:
+        check = source.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise ValueError(f"backup is damaged: {check}")
+        source.execute("SELECT count(*) FROM inbounds").fetchone()
+        create_backup("pre-restore", rotate=False)
+        started = time.perf_counter()
+        with phase("backup"):
+            source.backup(get_db().conn)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    finally:
+        source.close()
+        invalidate_snapshot()
+    print(
+        f"✅ Restored {path} in {elapsed_ms:.0f} ms. "
+        "Restart x-ui (x-ui restart) so it reloads the database."
+    )
+    return elapsed_ms
+
+
+# ------------------------- Compaction ------------------------- #
+def database_files_size(path):
+    """Sizes in bytes of the database file and its WAL (0 when absent)."""
+    return tuple(
+        os.path.getsize(f) if os.path.exists(f) else 0 for f in (path, path + "-wal")
+    )
+
+
+def compact_database(vacuum=True):
+    """
+    Give the space freed by large purges back to the file system: checkpoint
+    the WAL into the database and truncate it, then (unless vacuum=False)
+    VACUUM, which rebuilds the file without free pages and needs the write
+    lock for as long as it runs. Prints and returns what it reclaimed.
+    """
+    db = get_db()
+    path = current_db_path()
+    conn = db.conn
+    before = database_files_size(path)
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    started = time.perf_counter()
+    busy = 0
+    with phase("compact"):
+        if db.journal_mode == "wal":
+            busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        if vacuum:
+            conn.execute("VACUUM")
+            if db.journal_mode == "wal":
+                busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    after = database_files_size(path)
+    invalidate_snapshot()
+    result = {
+        "db_before": before[0],
+        "db_after": after[0],
+        "wal_before": before[1],
+        "wal_after": after[1],
+        "free_pages": free_pages,
+        "reclaimed": sum(before) - sum(after),
+        "checkpoint_busy": bool(busy),
+        "ms": round(elapsed_ms, 1),
+    }
+    count("bytes_reclaimed", max(result["reclaimed"], 0))
+    mb = 1048576
+    print(
+        f"🧹 Reclaimed {result['reclaimed'] / mb:.1f} MB in {elapsed_ms:.0f} ms "
+        f"(database {before[0] / mb:.1f} → {after[0] / mb:.1f} MB, "
+        f"WAL {before[1] / mb:.1f} → {after[1] / mb:.1f} MB)"
+    )
+    if busy:
+        print("⚠️ x-ui was reading, so the WAL could not be truncated completely.")
+    return result
+
+
+def compact_after_purge(removed):
+    """Compact once a deletion removed at least XUIM_COMPACT_AFTER users."""
+    if COMPACT_AFTER and removed >= COMPACT_AFTER:
+        try:
+            compact_database()
+        except Exception as e:
+            print(f"❌ Compaction failed: {e}")
 
 
 # ------------------------- Menu ------------------------- #
@@ -76,262 +627,1480 @@ def select_inbound():
     return inbounds[idx - 1][0]
 
 
-# ------------------------- Users Handling ------------------------- #
-def get_expired_users(days=0, name=None, inbound_id=None):
-    conn = connect_db()
-    cursor = conn.cursor()
+# ------------------------- Client Snapshot ------------------------- #
+def client_email(client):
+    return (
+        client.get("email")
+        or client.get("emailAddress")
+        or client.get("id")
+        or "<no-email>"
+    )
+
+
+def settings_hash(settings_json):
+    return hashlib.blake2b(settings_json.encode(), digest_size=16).digest()
+
+
+def db_signature(path=None):
+    """
+    Cheap change marker for the database: mtime and size of the db file and
+    its WAL. Any write by x-ui or by this tool changes at least one of them.
+    """
+    path = path or current_db_path()
+    signature = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class ClientRecord:
+    """
+    Compact view of one client: only the fields the reports need, with the
+    email interned. up/down are filled from client_traffics on demand.
+    """
+
+    __slots__ = (
+        "email",
+        "inbound_id",
+        "port",
+        "expiry_ms",
+        "enable",
+        "total",
+        "up",
+        "down",
+        "all_time",
+    )
+
+    def __init__(self, email, inbound_id, port, expiry_ms, enable, total):
+        self.email = sys.intern(email)
+        self.inbound_id = inbound_id
+        self.port = port
+        self.expiry_ms = expiry_ms
+        self.enable = enable
+        self.total = total
+        self.up = 0
+        self.down = 0
+        self.all_time = 0
+
+    @property
+    def expiry(self):
+        return self.expiry_ms // 1000
+
+    def days_expired(self, now=None):
+        return ((now or int(time.time())) - self.expiry) // DAY
+
+    def as_dict(self, usage=True):
+        """usage=False leaves out up/down/all_time (not loaded, so still 0)."""
+        d = {
+            "inbound_id": self.inbound_id,
+            "port": self.port,
+            "email": self.email,
+            "expiryTime": self.expiry,
+            "enable": self.enable,
+            "total": self.total,
+        }
+        if usage:
+            d.update(up=self.up, down=self.down, all_time=self.all_time)
+        if 0 < self.expiry < time.time():
+            d["days_expired"] = self.days_expired()
+        return d
+
+
+CACHE_STATS = {"hits": 0, "misses": 0, "parsed": 0, "reused": 0}
+
+
+class ClientSnapshot:
+    """
+    All inbounds decoded once, flattened into one list of ClientRecord.
+    Decoded settings are not kept; mutations read the inbounds they change.
+
+    The snapshot is keyed on PRAGMA data_version plus the db file signature.
+    When either moves, every inbound's settings blob is hashed and only the
+    inbounds whose hash changed are decoded again; on large databases they
+    are decoded by a process pool (see decode_in_parallel).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.version = None
+        self.inbounds = {}
+        self.clients = []
+
+    def current_version(self):
+        data_version = self.db.reader.execute("PRAGMA data_version").fetchone()[0]
+        return data_version, db_signature(self.db.path)
+
+    def refresh(self):
+        version = self.current_version()
+        if version == self.version:
+            CACHE_STATS["hits"] += 1
+            debug(f"snapshot cache hit {CACHE_STATS}")
+            return
+        CACHE_STATS["misses"] += 1
+
+        # Serially, iterate the cursor so only one settings blob is alive at
+        # a time; in parallel, blobs to decode are collected for the pool.
+        parallel = parallel_decode_workers(self.db) > 1
+        with phase("sql"):
+            rows = self.db.reader.execute("SELECT id, settings, port FROM inbounds")
+        inbounds = {}
+        pending, blobs = [], []
+        parsed = 0
+        for inbound_id, settings_json, port in rows:
+            with phase("hash"):
+                digest = settings_hash(settings_json or "")
+            entry = self.inbounds.get(inbound_id)
+            if entry and entry["hash"] == digest and entry["port"] == port:
+                inbounds[inbound_id] = entry
+                continue
+            if parallel:
+                inbounds[inbound_id] = None  # keeps the inbound order
+                pending.append((inbound_id, port, digest))
+                blobs.append(settings_json)
+                continue
+            entry = self._decode(inbound_id, port, settings_json, digest)
+            if entry:
+                inbounds[inbound_id] = entry
+                parsed += 1
+        if pending:
+            for (inbound_id, port, digest), clients in zip(
+                pending, decode_in_parallel(blobs)
+            ):
+                entry = self._entry(inbound_id, port, digest, clients)
+                if entry:
+                    inbounds[inbound_id] = entry
+                    parsed += 1
+                else:
+                    del inbounds[inbound_id]
+        count("inbounds_scanned", len(inbounds))
+
+        CACHE_STATS["parsed"] += parsed
+        CACHE_STATS["reused"] += len(inbounds) - parsed
+        self.inbounds = inbounds
+        self.clients = [c for entry in inbounds.values() for c in entry["clients"]]
+        self.version = version
+        debug(
+            f"snapshot cache miss: decoded {parsed}, reused "
+            f"{len(inbounds) - parsed} inbounds {CACHE_STATS}"
+        )
+
+    @staticmethod
+    def _decode(inbound_id, port, settings_json, digest):
+        clients = decode_clients_or_none(settings_json)
+        return ClientSnapshot._entry(inbound_id, port, digest, clients)
+
+    @staticmethod
+    def _entry(inbound_id, port, digest, clients):
+        if clients is None:
+            return None
+        return {
+            "port": port,
+            "hash": digest,
+            "clients": [
+                ClientRecord(email, inbound_id, port, expiry or 0, enable, total or 0)
+                for email, expiry, enable, total in clients
+            ],
+        }
+
+    def select(self, inbound_id=None):
+        if not inbound_id:
+            return self.clients
+        entry = self.inbounds.get(inbound_id)
+        return entry["clients"] if entry else []
+
+
+def decode_clients_or_none(settings_json):
+    """decode_clients(), with None for settings that cannot be decoded."""
     try:
-        if inbound_id:
-            cursor.execute(
-                "SELECT id, settings, port FROM inbounds WHERE id=?", (inbound_id,)
-            )
-        else:
-            cursor.execute("SELECT id, settings, port FROM inbounds")
-        rows = cursor.fetchall()
+        return decode_clients(settings_json)
+    except Exception:
+        return None
+
+
+def parallel_decode_workers(db):
+    """
+    Processes to decode a snapshot of `db` with: 1 (serial) when the
+    database is under XUIM_PARALLEL_MIN_MB, where starting a pool costs
+    more than it saves, when XUIM_DECODE_WORKERS < 2, and inside fleet
+    workers, which already run databases side by side.
+    """
+    if DECODE_WORKERS < 2 or getattr(_local, "db_path", None):
+        return 1
+    pages = db.reader.execute("PRAGMA page_count").fetchone()[0]
+    page_size = db.reader.execute("PRAGMA page_size").fetchone()[0]
+    if pages * page_size < PARALLEL_MIN_MB * 1048576:
+        return 1
+    return DECODE_WORKERS
+
+
+def decode_in_parallel(blobs):
+    """
+    decode_clients_or_none() of each settings blob, in order, spread over a
+    process pool. Workers send back only the compact field tuples. A lone
+    blob, or changed blobs under XUIM_PARALLEL_MIN_MB in total, are decoded
+    here instead.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    size = sum(len(b or "") for b in blobs)
+    workers = min(DECODE_WORKERS, len(blobs))
+    if workers < 2 or size < PARALLEL_MIN_MB * 1048576:
+        return [decode_clients_or_none(b) for b in blobs]
+    debug(f"decoding {len(blobs)} inbounds ({size} B) in {workers} processes")
+    with phase("json_decode"):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(decode_clients_or_none, blobs))
+    count("bytes_decoded", size)
+    count("clients_scanned", sum(len(r) for r in results if r))
+    count("decode_workers", workers)
+    return results
+
+
+def get_snapshot():
+    """Return the shared snapshot, refreshing only what changed in the database."""
+    db = get_db()
+    if db.snapshot is None:
+        db.snapshot = ClientSnapshot(db)
+    try:
+        db.snapshot.refresh()
     except Exception as e:
         print(f"DB query failed: {e}")
-        conn.close()
-        return []
+        return ClientSnapshot(db)
+    return db.snapshot
+
+
+def invalidate_snapshot():
+    """Force a re-check after our own writes; unchanged inbounds are kept."""
+    snapshot = get_db().snapshot
+    if snapshot is not None:
+        snapshot.version = None
+
+
+# ------------------------- Client Index ------------------------- #
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS inbounds (id INTEGER PRIMARY KEY, hash BLOB);
+CREATE TABLE IF NOT EXISTS clients (
+    email TEXT, client_id TEXT, inbound_id INTEGER, position INTEGER
+);
+CREATE INDEX IF NOT EXISTS clients_email ON clients (email);
+CREATE INDEX IF NOT EXISTS clients_client_id ON clients (client_id);
+CREATE INDEX IF NOT EXISTS clients_inbound ON clients (inbound_id);
+"""
 
-    expired_users = []
-    for row in rows:
-        inbound_id_row, settings_json, port = row
+
+class ClientIndex:
+    """
+    Sidecar SQLite file that maps email and client id to inbound id and
+    position in the clients list, with each inbound's last-known settings
+    hash. One file per x-ui database under XUIM_CACHE_DIR; when that is not
+    writable the index lives in memory for this run.
+
+    refresh() does nothing while PRAGMA data_version and the db file
+    signature stay put (across runs too). Otherwise every settings blob is
+    hashed and only the inbounds whose hash moved are decoded and indexed.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.version = None
+        name = hashlib.blake2b(
+            os.path.abspath(db.path).encode(), digest_size=8
+        ).hexdigest()
+        self.path = os.path.join(CACHE_DIR, f"index-{name}.db")
         try:
-            settings = json.loads(settings_json)
-        except Exception:
-            continue
-        clients = settings.get("clients") or []
-        if not isinstance(clients, list):
-            continue
-        for c in clients:
-            expiry_ms = c.get("expiryTime", 0) or 0
-            expiry_sec = expiry_ms // 1000
-            if expiry_sec <= 0:
-                continue
-            if expiry_sec < now:
-                days_expired = (now - expiry_sec) // (24 * 3600)
-                if days > 0 and days_expired < days:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            self.conn = self._open(self.path)
+        except (OSError, sqlite3.Error) as e:
+            debug(f"client index kept in memory ({self.path}: {e})")
+            self.path = ":memory:"
+            self.conn = self._open(self.path)
+
+    @staticmethod
+    def _open(path):
+        conn = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None
+        )
+        conn.executescript(INDEX_SCHEMA)
+        return conn
+
+    def refresh(self, force=False):
+        data_version = self.db.reader.execute("PRAGMA data_version").fetchone()[0]
+        signature = json_dumps(db_signature(self.db.path))
+        if not force and self.version == (data_version, signature):
+            return 0
+        stored = self.conn.execute(
+            "SELECT value FROM meta WHERE key='signature'"
+        ).fetchone()
+        if not force and stored and stored[0] == signature:
+            self.version = (data_version, signature)
+            return 0
+
+        known = (
+            {} if force else dict(self.conn.execute("SELECT id, hash FROM inbounds"))
+        )
+        changed = scanned = 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if force:
+                self.conn.execute("DELETE FROM clients")
+                self.conn.execute("DELETE FROM inbounds")
+            # One scan; iterating the cursor keeps one settings blob alive.
+            with phase("sql"):
+                rows = self.db.reader.execute("SELECT id, settings FROM inbounds")
+            for inbound_id, settings_json in rows:
+                scanned += 1
+                with phase("hash"):
+                    digest = settings_hash(settings_json or "")
+                if known.pop(inbound_id, None) == digest:
                     continue
-                email = (
-                    c.get("email")
-                    or c.get("emailAddress")
-                    or c.get("id")
-                    or "<no-email>"
+                try:
+                    clients = decode_settings(settings_json).get("clients") or []
+                except Exception:
+                    clients = []
+                self.conn.execute(
+                    "DELETE FROM clients WHERE inbound_id=?", (inbound_id,)
                 )
-                if name and name.lower() not in email.lower():
-                    continue
-                expired_users.append(
-                    {
-                        "port": port,
-                        "email": email,
-                        "expiryTime": expiry_sec,
-                        "days_expired": days_expired,
-                    }
+                self.conn.executemany(
+                    "INSERT INTO clients VALUES (?, ?, ?, ?)",
+                    (
+                        (
+                            client_email(c),
+                            c.get("id") or c.get("password"),
+                            inbound_id,
+                            position,
+                        )
+                        for position, c in enumerate(clients)
+                        if isinstance(c, dict)
+                    ),
                 )
-    conn.close()
-    return expired_users
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO inbounds VALUES (?, ?)",
+                    (inbound_id, digest),
+                )
+                changed += 1
+            for inbound_id in known:
+                self.conn.execute(
+                    "DELETE FROM clients WHERE inbound_id=?", (inbound_id,)
+                )
+                self.conn.execute("DELETE FROM inbounds WHERE id=?", (inbound_id,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,)
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.version = (data_version, signature)
+        count("index_inbounds_decoded", changed)
+        debug(f"client index: re-indexed {changed} of {scanned} inbounds")
+        return changed
+
+    def lookup(self, emails):
+        """Sorted ids of the inbounds that hold any of `emails`."""
+        emails = list(emails)
+        found = set()
+        for i in range(0, len(emails), USAGE_CHUNK):
+            chunk = emails[i : i + USAGE_CHUNK]
+            found.update(
+                r[0]
+                for r in self.conn.execute(
+                    "SELECT DISTINCT inbound_id FROM clients "
+                    f"WHERE email IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return sorted(found)
 
+    def find(self, key):
+        """(email, client_id, inbound_id, position) rows for an email or client id."""
+        return self.conn.execute(
+            "SELECT email, client_id, inbound_id, position FROM clients "
+            "WHERE email=? OR client_id=? ORDER BY inbound_id, position",
+            (key, key),
+        ).fetchall()
 
-def get_not_started_users(inbound_id=None):
-    conn = connect_db()
-    cursor = conn.cursor()
+
+def get_index():
+    """The refreshed client index of the current database."""
+    db = get_db()
+    if db.index is None:
+        db.index = ClientIndex(db)
+    db.index.refresh()
+    return db.index
+
+
+def locate_inbounds(emails):
+    """
+    Ids of the inbounds holding any of `emails`, from the client index, so a
+    change for a few users only reads those inbounds. None (scan every
+    inbound) when the index is disabled or unusable.
+    """
+    if not USE_INDEX:
+        return None
     try:
-        if inbound_id:
-            cursor.execute(
-                "SELECT id, settings, port FROM inbounds WHERE id=?", (inbound_id,)
-            )
-        else:
-            cursor.execute("SELECT id, settings, port FROM inbounds")
-        rows = cursor.fetchall()
+        return get_index().lookup(emails)
     except Exception as e:
-        print(f"DB query failed: {e}")
-        conn.close()
-        return []
+        debug(f"client index unavailable: {e}")
+        return None
 
-    not_started = []
-    for row in rows:
-        inbound_id_row, settings_json, port = row
+
+# ------------------------- Optimistic Writes ------------------------- #
+def mutate_inbounds(
+    transform, inbound_ids=None, batch=None, finish=None, dry_run=False
+):
+    """
+    Change inbound settings without doing JSON work under the write lock.
+    The inbounds are read with one query on the reader connection (one per
+    USAGE_CHUNK ids), and each is decoded, passed to
+    transform(inbound_id, port, settings), which edits settings in place and
+    returns a truthy result when it changed something, and encoded again, all
+    outside any transaction. Staged inbounds are then written in short
+    BEGIN IMMEDIATE transactions of about `batch` results each (default: one
+    transaction), each inbound only if its settings still hash the same as
+    when it was read. Inbounds that x-ui changed in between are read and
+    transformed again, up to CAS_RETRIES times.
+    finish(cursor, results) runs inside every transaction with the results
+    of the inbounds it wrote, for the matching client_traffics changes.
+    An inbound whose encoded settings come out byte for byte the same as the
+    stored ones is not rewritten, though finish still sees its result.
+    Returns {inbound_id: result} of the written (or, with dry_run, staged)
+    inbounds; get_db().last_write holds transactions, lock time, conflicts,
+    bytes written and, as "unresolved", {inbound_id: result} of the inbounds
+    still changing after the last retry, which were not written.
+    """
+    db = get_db()
+    stats = new_write_stats()
+    results = {}
+
+    def scan(ids):
+        """(id, port, settings) of `ids`, or of every inbound for None."""
+        query = "SELECT id, port, settings FROM inbounds"
+        if ids is None:
+            chunks = [()]
+        else:
+            chunks = [ids[i : i + USAGE_CHUNK] for i in range(0, len(ids), USAGE_CHUNK)]
+        for chunk in chunks:
+            sql = query
+            if chunk:
+                sql += f" WHERE id IN ({','.join('?' * len(chunk))})"
+            with phase("sql"):
+                rows = db.reader.execute(sql, chunk)
+            # Iterate the cursor so only one settings blob is alive at a time.
+            for row in rows:
+                count("inbounds_scanned")
+                yield row
+
+    def stage(inbound_id, port, settings_json):
+        with phase("hash"):
+            digest = settings_hash(settings_json or "")
         try:
-            settings = json.loads(settings_json)
+            settings = decode_settings(settings_json)
         except Exception:
+            return None
+        result = transform(inbound_id, port, settings)
+        if not result:
+            return None
+        return inbound_id, digest, encode_settings(settings), result
+
+    def commit(staged):
+        conflicts, written = [], {}
+        with db.write() as cursor:
+            for inbound_id, digest, settings_json, result in staged:
+                with phase("sql"):
+                    row = cursor.execute(
+                        "SELECT settings FROM inbounds WHERE id=?", (inbound_id,)
+                    ).fetchone()
+                with phase("hash"):
+                    unchanged = (
+                        row is not None and settings_hash(row[0] or "") == digest
+                    )
+                if not unchanged:
+                    conflicts.append(inbound_id)
+                    continue
+                size = store_settings(cursor, inbound_id, settings_json, row[0])
+                stats["bytes_written"] += size
+                stats["unchanged"] += not size
+                written[inbound_id] = result
+            if finish and written:
+                finish(cursor, written)
+        results.update(written)
+        note_transaction(stats)
+        stats["conflicts"] += len(conflicts)
+        count("write_conflicts", len(conflicts))
+        return conflicts
+
+    todo = None if inbound_ids is None else list(inbound_ids)
+    staged_results = {}
+    try:
+        for attempt in range(CAS_RETRIES + 1):
+            if attempt:
+                debug(f"retrying {len(todo)} inbounds changed by x-ui: {todo}")
+            conflicts, staged, size = [], [], 0
+            for inbound_id, port, settings_json in scan(todo):
+                entry = stage(inbound_id, port, settings_json)
+                if entry is None:
+                    continue
+                staged_results[inbound_id] = entry[3]
+                if dry_run:
+                    results[inbound_id] = entry[3]
+                    continue
+                staged.append(entry)
+                size += len(entry[3]) if hasattr(entry[3], "__len__") else 1
+                if batch and size >= batch:
+                    conflicts += commit(staged)
+                    staged, size = [], 0
+            if staged:
+                conflicts += commit(staged)
+            todo = conflicts
+            if not todo:
+                break
+        stats["unresolved"] = {iid: staged_results[iid] for iid in todo}
+    finally:
+        if not dry_run:
+            invalidate_snapshot()
+    if todo:
+        print(
+            f"❌ {len(todo)} inbounds kept changing while writing and were "
+            f"skipped: {', '.join(map(str, todo))}"
+        )
+    return results
+
+
+def new_write_stats():
+    """Fresh lock/conflict counters, also kept as get_db().last_write."""
+    stats = {"transactions": 0, "lock_ms": 0.0, "max_lock_ms": 0.0, "conflicts": 0}
+    stats.update(unresolved={}, bytes_written=0, unchanged=0)
+    get_db().last_write = stats
+    return stats
+
+
+def note_transaction(stats):
+    """Add the write transaction that just ended to `stats`."""
+    lock_ms = get_db().last_lock_ms
+    stats["transactions"] += 1
+    stats["lock_ms"] += lock_ms
+    stats["max_lock_ms"] = max(stats["max_lock_ms"], lock_ms)
+
+
+def write_report():
+    """Lock time, bytes written and conflicts of the last mutate_inbounds() call."""
+    stats = get_db().last_write
+    if not stats:
+        return ""
+    text = (
+        f"(write lock held {stats['lock_ms']:.1f} ms in "
+        f"{stats['transactions']} transaction(s), max {stats['max_lock_ms']:.1f} ms"
+    )
+    if stats["bytes_written"]:
+        text += f"; {stats['bytes_written'] / 1024:.1f} KB of settings written"
+    if stats["unchanged"]:
+        text += f"; {stats['unchanged']} unchanged inbound(s) not rewritten"
+    # Every unresolved inbound also conflicted on the last attempt.
+    retried = stats["conflicts"] - len(stats["unresolved"])
+    if retried:
+        text += f"; {retried} inbound(s) changed by x-ui were retried"
+    if stats["unresolved"]:
+        text += (
+            f"; {len(stats['unresolved'])} inbound(s) kept changing and were "
+            "not written"
+        )
+    return text + ")"
+
+
+# ------------------------- Users Handling ------------------------- #
+def get_expired_users(days=0, name=None, inbound_id=None):
+    now = int(time.time())
+    name = name.lower() if name else None
+    clients = get_snapshot().select(inbound_id)
+    with phase("filter"):
+        return [
+            c
+            for c in clients
+            if 0 < c.expiry < now
+            and not (days > 0 and c.days_expired(now) < days)
+            and not (name and name not in c.email.lower())
+        ]
+
+
+def get_not_started_users(inbound_id=None):
+    clients = get_snapshot().select(inbound_id)
+    with phase("filter"):
+        return [c for c in clients if c.expiry < 0]
+
+
+def get_unlimited_users(inbound_id=None):
+    clients = get_snapshot().select(inbound_id)
+    with phase("filter"):
+        return [c for c in clients if c.expiry_ms == 0]
+
+
+def get_inactive_users(inbound_id=None):
+    clients = get_snapshot().select(inbound_id)
+    with phase("filter"):
+        return [c for c in clients if not c.enable]
+
+
+def load_usage():
+    """client_traffics as {email: (up, down, all_time)}, read in one query."""
+    with phase("sql"):
+        rows = (
+            get_db()
+            .reader.execute("SELECT email, up, down, all_time FROM client_traffics")
+            .fetchall()
+        )
+    count("traffic_rows", len(rows))
+    with phase("filter"):
+        return {e: (up or 0, down or 0, at or 0) for e, up, down, at in rows}
+
+
+def attach_usage(clients):
+    """Fill up/down/all_time of the given records, joined in memory."""
+    usage = load_usage()
+    with phase("filter"):
+        for c in clients:
+            c.up, c.down, c.all_time = usage.get(c.email, (0, 0, 0))
+    return clients
+
+
+def attach_usage_indexed(clients):
+    """
+    Like attach_usage, but looks the emails up through the email index in
+    chunks, so memory stays bounded by the size of `clients`.
+    """
+    reader = get_db().reader
+    for i in range(0, len(clients), USAGE_CHUNK):
+        chunk = clients[i : i + USAGE_CHUNK]
+        marks = ",".join("?" * len(chunk))
+        with phase("sql"):
+            rows = reader.execute(
+                "SELECT email, up, down, all_time FROM client_traffics "
+                f"WHERE email IN ({marks})",
+                [c.email for c in chunk],
+            ).fetchall()
+        usage = {e: (up or 0, down or 0, at or 0) for e, up, down, at in rows}
+        for c in chunk:
+            c.up, c.down, c.all_time = usage.get(c.email, (0, 0, 0))
+    return clients
+
+
+def iter_clients(inbound_id=None, usage=False):
+    """
+    Yield client records inbound by inbound without building the snapshot.
+    Each inbound is read in its own short query, so no read transaction stays
+    open while the consumer works, and only one inbound's clients are alive
+    at a time. usage: fill up/down/all_time as well.
+    """
+    reader = get_db().reader
+    if inbound_id:
+        ids = [inbound_id]
+    else:
+        with phase("sql"):
+            ids = [r[0] for r in reader.execute("SELECT id FROM inbounds")]
+    for iid in ids:
+        rows = fetch_inbounds(
+            reader.cursor(), "SELECT port, settings FROM inbounds WHERE id=?", (iid,)
+        )
+        if not rows:
             continue
-        clients = settings.get("clients") or []
-        if not isinstance(clients, list):
+        entry = ClientSnapshot._decode(iid, rows[0][0], rows[0][1], None)
+        if not entry:
             continue
-        for c in clients:
-            expiry_ms = c.get("expiryTime", 0) or 0
-            expiry_sec = expiry_ms // 1000
-            if expiry_sec >= 0:
-                continue
-            email = (
-                c.get("email") or c.get("emailAddress") or c.get("id") or "<no-email>"
-            )
-            not_started.append({"port": port, "email": email, "expiryTime": expiry_sec})
-    conn.close()
-    return not_started
+        clients = entry["clients"]
+        if usage:
+            attach_usage_indexed(clients)
+        yield from clients
 
 
-def get_unlimited_users(inbound_id=None):
-    conn = connect_db()
-    cursor = conn.cursor()
+def get_over_quota_users(inbound_id=None):
+    """Clients with a traffic quota whose up + down reached it."""
+    clients = [c for c in get_snapshot().select(inbound_id) if c.total > 0]
     try:
-        if inbound_id:
-            cursor.execute(
-                "SELECT id, settings, port FROM inbounds WHERE id=?", (inbound_id,)
-            )
-        else:
-            cursor.execute("SELECT id, settings, port FROM inbounds")
-        rows = cursor.fetchall()
+        attach_usage(clients)
     except Exception as e:
         print(f"DB query failed: {e}")
-        conn.close()
         return []
-
-    unlimited = []
-    for row in rows:
-        inbound_id_row, settings_json, port = row
-        try:
-            settings = json.loads(settings_json)
-        except Exception:
-            continue
-        clients = settings.get("clients") or []
-        for c in clients:
-            expiry_ms = c.get("expiryTime", 0) or 0
-            if expiry_ms != 0:
-                continue
-            email = (
-                c.get("email") or c.get("emailAddress") or c.get("id") or "<no-email>"
-            )
-            unlimited.append({"port": port, "email": email})
-    conn.close()
-    return unlimited
+    return [c for c in clients if c.up + c.down >= c.total]
 
 
-def get_inactive_users(inbound_id=None):
-    conn = connect_db()
-    cursor = conn.cursor()
+def get_top_users(limit=10, inbound_id=None, over_quota=False, where=None):
+    """
+    The `limit` clients with the most traffic (up + down), heaviest first.
+    over_quota: only clients past their quota, ranked by how far past it.
+    A bounded heap keeps this O(n log limit) however many clients there are.
+    """
+    clients = filter_users(get_snapshot().select(inbound_id), where)
     try:
-        if inbound_id:
-            cursor.execute(
-                "SELECT id, settings, port FROM inbounds WHERE id=?", (inbound_id,)
-            )
-        else:
-            cursor.execute("SELECT id, settings, port FROM inbounds")
-        rows = cursor.fetchall()
+        attach_usage(clients)
     except Exception as e:
         print(f"DB query failed: {e}")
-        conn.close()
         return []
+    with phase("filter"):
+        if over_quota:
+            clients = (c for c in clients if 0 < c.total <= c.up + c.down)
+            return heapq.nlargest(limit, clients, key=lambda c: c.up + c.down - c.total)
+        return heapq.nlargest(limit, clients, key=lambda c: c.up + c.down)
+
+
+def load_temp_keys(cursor, emails):
+    """Fill the connection's temp.xuim_keys table for set-based statements."""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS xuim_keys (email TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.xuim_keys")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO temp.xuim_keys (email) VALUES (?)",
+        ((e,) for e in emails),
+    )
 
-    inactive = []
-    for row in rows:
-        inbound_id_row, settings_json, port = row
-        try:
-            settings = json.loads(settings_json)
-        except Exception:
-            continue
-        clients = settings.get("clients") or []
-        for c in clients:
-            if c.get("enable", True):
-                continue
-            email = (
-                c.get("email") or c.get("emailAddress") or c.get("id") or "<no-email>"
-            )
-            inactive.append({"port": port, "email": email})
-    conn.close()
-    return inactive
+
+def delete_traffic_rows(cursor, emails):
+    """Delete client_traffics rows for all emails with one set-based statement."""
+    load_temp_keys(cursor, emails)
+    cursor.execute(
+        "DELETE FROM client_traffics WHERE email IN (SELECT email FROM temp.xuim_keys)"
+    )
+    return cursor.rowcount
 
 
 def delete_users(users):
     """
     Delete users completely from all inbounds and client_traffics.
-    users: list of dicts with keys 'email'
+    users: client records (anything with an .email)
+    Large deletions are committed in chunks of about DELETE_CHUNK_SIZE users
+    so x-ui is never blocked for long.
+    Returns the number of clients removed, or None on failure or when some
+    inbounds kept changing and their users were left in place.
     """
     if not users:
         print("No users to delete.")
-        return
+        return 0
 
-    emails_to_remove = set(u["email"] for u in users if u.get("email"))
+    emails_to_remove = set(
+        u.email for u in users if u.email and u.email != "<no-email>"
+    )
     if not emails_to_remove:
         print("No valid emails to delete.")
-        return
+        return 0
 
-    conn = connect_db()
-    cursor = conn.cursor()
+    found = set()
     removed_count = 0
+    traffic_count = 0
+
+    def transform(inbound_id, port, settings):
+        kept, gone = [], []
+        for c in settings.get("clients") or []:
+            (gone if client_email(c) in emails_to_remove else kept).append(c)
+        if not gone:
+            return None
+        settings["clients"] = kept
+        return [client_email(c) for c in gone]
+
+    def finish(cursor, written):
+        nonlocal removed_count, traffic_count
+        emails = set(chain.from_iterable(written.values()))
+        traffic_count += delete_traffic_rows(cursor, emails)
+        removed_count += sum(map(len, written.values()))
+        found.update(emails)
 
     try:
-        # Loop all inbounds
-        cursor.execute("SELECT id, settings FROM inbounds")
-        rows = cursor.fetchall()
-        for inbound_id, settings_json in rows:
-            try:
-                settings = json.loads(settings_json)
-            except Exception:
-                continue
-
-            clients = settings.get("clients") or []
-            new_clients = [
-                c
-                for c in clients
-                if (c.get("email") or c.get("id") or "") not in emails_to_remove
-            ]
-
-            if len(new_clients) < len(clients):
-                settings["clients"] = new_clients
-                cursor.execute(
-                    "UPDATE inbounds SET settings=? WHERE id=?",
-                    (json.dumps(settings, ensure_ascii=False), inbound_id),
-                )
-                removed_count += len(clients) - len(new_clients)
-
-        # Delete traffic records for all emails
-        for email in emails_to_remove:
-            cursor.execute("DELETE FROM client_traffics WHERE email=?", (email,))
-
-        conn.commit()
-        print(f"✅ Deleted {removed_count} users and removed their traffic records.")
+        auto_backup("delete")
+        mutate_inbounds(
+            transform,
+            locate_inbounds(emails_to_remove),
+            batch=DELETE_CHUNK_SIZE,
+            finish=finish,
+        )
+        # Traffic rows of emails that no inbound has any more; clients of
+        # inbounds that kept changing are still there and keep theirs.
+        unresolved = get_db().last_write["unresolved"]
+        kept = set(chain.from_iterable(unresolved.values()))
+        leftover = emails_to_remove - found - kept
+        if leftover:
+            with get_db().write() as cursor:
+                traffic_count += delete_traffic_rows(cursor, leftover)
+            note_transaction(get_db().last_write)
+
+        if unresolved:
+            print(
+                f"❌ Deleted only {removed_count} users and {traffic_count} "
+                f"traffic records; {len(kept)} users were not deleted. "
+                f"{write_report()}"
+            )
+            return None
+        print(
+            f"✅ Deleted {removed_count} users and {traffic_count} traffic "
+            f"records. {write_report()}"
+        )
+        compact_after_purge(removed_count)
+        return removed_count
 
     except Exception as e:
         print(f"Failed to delete users: {e}")
+        if removed_count:
+            print(f"{removed_count} users were already deleted.")
+        return None
     finally:
-        conn.close()
+        invalidate_snapshot()
+
+
+# ------------------------- Query Engine ------------------------- #
+QUERY_HELP = """\
+Filter expression: conditions joined with and / or / not and parentheses.
+  Fields:  email, inbound, port, enable, days_left, expired_days,
+           up, down, traffic (up+down), quota
+  Ops:     = != < <= > >=, ~ (contains), =~ (regex), like (glob)
+  States:  expired, not_started, unlimited, active, enabled, disabled, over_quota
+  Sizes:   500MB, 1GB, 2TB
+  Example: expired and expired_days > 30 and email ~ trial and traffic < 1GB"""
+
+QUERY_TOKEN = re.compile(
+    r"""\s*(?:(?P<paren>[()])|(?P<op>=~|!=|<=|>=|==|=|<|>|~)"""
+    r"""|(?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<word>[^\s()=!<>~]+))"""
+)
+QUERY_ESCAPE = re.compile(r"\\([\"'\\])")
+QUERY_UNITS = {"kb": 1024, "mb": 1024**2, "gb": GB, "tb": 1024**4}
+QUERY_FIELDS = {
+    "inbound": "c.inbound_id",
+    "port": "c.port",
+    "enable": "c.enable",
+    "days_left": "((c.expiry - now) // 86400)",
+    "expired_days": "((now - c.expiry) // 86400)",
+    "up": "c.up",
+    "down": "c.down",
+    "traffic": "(c.up + c.down)",
+    "quota": "c.total",
+}
+QUERY_GUARDS = {
+    "days_left": "c.expiry > 0",
+    "expired_days": "0 < c.expiry < now",
+}
+QUERY_STATES = {
+    "expired": "(0 < c.expiry < now)",
+    "not_started": "(c.expiry < 0)",
+    "unlimited": "(c.expiry_ms == 0)",
+    "active": "(c.expiry_ms == 0 or c.expiry >= now)",
+    "enabled": "bool(c.enable)",
+    "disabled": "(not c.enable)",
+    "over_quota": "(c.total > 0 and c.up + c.down >= c.total)",
+}
+QUERY_USAGE_FIELDS = {"up", "down", "traffic"}
+
+
+class CompiledQuery:
+    """
+    A filter expression compiled into one Python function that tests every
+    client in a single pass. Regexes and globs are compiled once; the
+    lower-cased email is computed once per client and only when needed.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        for m in QUERY_TOKEN.finditer(text):
+            kind = m.lastgroup
+            if kind:
+                self.tokens.append((kind, m.group(kind)))
+        if (
+            "".join(m.group(0) for m in QUERY_TOKEN.finditer(text)).strip()
+            != text.strip()
+        ):
+            raise ValueError(f"cannot parse filter: {text!r}")
+        self.pos = 0
+        self.names = {}
+        self.uses_email = False
+        self.needs_usage = False
+        source = self._or()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"unexpected {self.tokens[self.pos][1]!r} in filter")
+
+        email = "        e = c.email.lower()\n" if self.uses_email else ""
+        code = (
+            "def query(clients, now):\n"
+            "    out = []\n"
+            "    append = out.append\n"
+            "    for c in clients:\n"
+            f"{email}"
+            f"        if {source}:\n"
+            "            append(c)\n"
+            "    return out\n"
+            "def stream(clients, now):\n"
+            "    for c in clients:\n"
+            f"{email}"
+            f"        if {source}:\n"
+            "            yield c\n"
+        )
+        namespace = dict(self.names)
+        exec(compile(code, "<xuim query>", "exec"), namespace)
+        self.run = namespace["query"]
+        self.run_stream = namespace["stream"]
+        self.source = source
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("filter ends unexpectedly")
+        self.pos += 1
+        return token
+
+    def _keyword(self, word):
+        kind, value = self._peek()
+        if kind == "word" and value.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def _or(self):
+        parts = [self._and()]
+        while self._keyword("or"):
+            parts.append(self._and())
+        return parts[0] if len(parts) == 1 else "(" + " or ".join(parts) + ")"
+
+    def _and(self):
+        parts = [self._not()]
+        while self._keyword("and"):
+            parts.append(self._not())
+        return parts[0] if len(parts) == 1 else "(" + " and ".join(parts) + ")"
+
+    def _not(self):
+        if self._keyword("not"):
+            return f"(not {self._not()})"
+        return self._atom()
+
+    def _atom(self):
+        kind, value = self._next()
+        if kind == "paren" and value == "(":
+            inner = self._or()
+            if self._next() != ("paren", ")"):
+                raise ValueError("missing ')' in filter")
+            return inner
+        if kind != "word":
+            raise ValueError(f"unexpected {value!r} in filter")
+        field = value.lower()
+        op_kind, op = self._peek()
+        if op_kind != "op" and not (op_kind == "word" and op.lower() == "like"):
+            if field in QUERY_STATES:
+                if field == "over_quota":
+                    self.needs_usage = True
+                return QUERY_STATES[field]
+            raise ValueError(f"unknown state {value!r}")
+        self.pos += 1
+        op = op.lower()
+        kind, literal = self._next()
+        if kind == "str":
+            literal = QUERY_ESCAPE.sub(r"\1", literal[1:-1])
+        elif kind != "word":
+            raise ValueError(f"expected a value after {op!r}")
+
+        if field == "email":
+            return self._email(op, literal)
+        if field == "state":
+            if op not in ("=", "==", "!=") or literal.lower() not in QUERY_STATES:
+                raise ValueError(f"invalid state comparison: state {op} {literal}")
+            expr = QUERY_STATES[literal.lower()]
+            return expr if op != "!=" else f"(not {expr})"
+        if field not in QUERY_FIELDS:
+            raise ValueError(f"unknown field {value!r}")
+        if op in ("~", "=~", "like"):
+            raise ValueError(f"{op!r} only works on email")
+        if field in QUERY_USAGE_FIELDS:
+            self.needs_usage = True
+        op = "==" if op == "=" else op
+        expr = f"{QUERY_FIELDS[field]} {op} {self._number(field, literal)!r}"
+        guard = QUERY_GUARDS.get(field)
+        return f"({guard} and {expr})" if guard else f"({expr})"
+
+    def _number(self, field, literal):
+        text = literal.lower()
+        if field == "enable":
+            if text in ("true", "1", "yes"):
+                return True
+            if text in ("false", "0", "no"):
+                return False
+            raise ValueError(f"enable must be true or false, not {literal!r}")
+        scale = 1
+        for unit, size in QUERY_UNITS.items():
+            if text.endswith(unit):
+                text, scale = text[: -len(unit)], size
+                break
+        try:
+            return int(float(text) * scale)
+        except (ValueError, OverflowError):
+            # OverflowError: inf, 1e999; int(nan) is a ValueError.
+            raise ValueError(f"{field} needs a finite number, not {literal!r}")
+
+    def _name(self, value):
+        name = f"_v{len(self.names)}"
+        self.names[name] = value
+        return name
+
+    def _email(self, op, literal):
+        if op in ("=~", "like"):
+            pattern = fnmatch.translate(literal) if op == "like" else literal
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"invalid regex {literal!r}: {e}")
+            return f"({self._name(regex.search)}(c.email) is not None)"
+        self.uses_email = True
+        literal = literal.lower()
+        if op == "~":
+            return f"({literal!r} in e)"
+        if op in ("=", "=="):
+            return f"(e == {literal!r})"
+        if op == "!=":
+            return f"(e != {literal!r})"
+        raise ValueError(f"{op!r} does not work on email")
+
+    def __call__(self, clients):
+        if self.needs_usage:
+            attach_usage(clients)
+        with phase("filter"):
+            return self.run(clients, int(time.time()))
+
+    def stream(self, clients):
+        """Filter lazily; usage must already be attached when needs_usage."""
+        return self.run_stream(clients, int(time.time()))
+
+
+def query_users(where, inbound_id=None):
+    """All clients matching a filter expression, in one pass over the snapshot."""
+    return CompiledQuery(where)(get_snapshot().select(inbound_id))
+
+
+def filter_users(users, where):
+    """Narrow a getter's result with an optional (compiled or text) filter."""
+    if not where:
+        return users
+    if isinstance(where, str):
+        where = CompiledQuery(where)
+    return where(users)
 
 
 # ------------------------- Display Tables ------------------------- #
-def show_table(users, status="expired"):
-    if not users:
+def format_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
+TABLE_COLUMNS = {
+    "expired": [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+        ("Expiry Time", lambda u: format_time(u.expiry)),
+        ("Days Expired", lambda u: u.days_expired()),
+    ],
+    "expiry_shift": [
+        ("Email", lambda u: u["email"]),
+        ("Inbound", lambda u: u["inbound_id"]),
+        ("Old Expiry", lambda u: format_time(u["old_expiry"])),
+        ("New Expiry", lambda u: format_time(u["new_expiry"])),
+    ],
+    "over_quota": [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+        ("Used (GB)", lambda u: round((u.up + u.down) / GB, 2)),
+        ("Quota (GB)", lambda u: round(u.total / GB, 2)),
+    ],
+    "top": [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+        ("Used (GB)", lambda u: round((u.up + u.down) / GB, 2)),
+        ("Quota (GB)", lambda u: round(u.total / GB, 2) if u.total else "-"),
+    ],
+    "not_started": [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+        ("Status", lambda u: "Not started"),
+    ],
+    "backups": [
+        ("File", lambda b: os.path.basename(b[0])),
+        ("Size (MB)", lambda b: round(b[1] / 1048576, 1)),
+        ("Created", lambda b: format_time(b[2])),
+    ],
+    "query": [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+        ("Expiry Time", lambda u: format_time(u.expiry) if u.expiry > 0 else "-"),
+        ("Enabled", lambda u: "yes" if u.enable else "no"),
+    ],
+    None: [
+        ("Email", lambda u: u.email),
+        ("Port", lambda u: u.port),
+    ],
+}
+USAGE_COLUMNS = [
+    ("Up (GB)", lambda u: round(u.up / GB, 2)),
+    ("Down (GB)", lambda u: round(u.down / GB, 2)),
+    ("All-time (GB)", lambda u: round(u.all_time / GB, 2)),
+]
+# Statuses whose rows are users, so usage columns can be added.
+USER_STATUSES = {
+    "expired",
+    "not_started",
+    "unlimited",
+    "inactive",
+    "over_quota",
+    "top",
+    "query",
+}
+# Statuses whose getters already joined client_traffics.
+USAGE_STATUSES = {"over_quota", "top"}
+
+
+class TableWriter:
+    """
+    Writes table rows as they are produced instead of building the whole
+    table first. Column widths come from the headers and the first `sample`
+    rows; a longer cell later on is written in full and only breaks the
+    alignment of its own row.
+    fmt: "grid" (boxed, like before), "plain" (aligned, no box) or "tsv".
+    """
+
+    def __init__(self, headers, fmt="grid", out=None, sample=None):
+        self.headers = headers
+        self.fmt = fmt
+        self.out = out or sys.stdout
+        self.sample = sample or TABLE_SAMPLE_ROWS
+        self.widths = None
+        self.numeric = None
+
+    def fit(self, rows):
+        self.widths = [len(h) for h in self.headers]
+        self.numeric = [True] * len(self.headers)
+        for row in rows:
+            for i, value in enumerate(row):
+                self.widths[i] = max(self.widths[i], len(str(value)))
+                if not isinstance(value, (int, float)):
+                    self.numeric[i] = False
+
+    def _line(self, char):
+        return "+" + "+".join(char * (w + 2) for w in self.widths) + "+\n"
+
+    def _cells(self, values, header=False):
+        cells = []
+        for value, width, numeric in zip(values, self.widths, self.numeric):
+            text = str(value)
+            cells.append(
+                text.rjust(width) if numeric and not header else text.ljust(width)
+            )
+        return cells
+
+    def write_header(self):
+        if self.fmt == "tsv":
+            self.out.write("\t".join(self.headers) + "\n")
+        elif self.fmt == "plain":
+            self.out.write("  ".join(self._cells(self.headers, True)).rstrip() + "\n")
+        else:
+            self.out.write(self._line("-"))
+            self.out.write("| " + " | ".join(self._cells(self.headers, True)) + " |\n")
+            self.out.write(self._line("="))
+
+    def write_row(self, row):
+        if self.fmt == "tsv":
+            self.out.write("\t".join(str(v) for v in row) + "\n")
+        elif self.fmt == "plain":
+            self.out.write("  ".join(self._cells(row)).rstrip() + "\n")
+        else:
+            self.out.write("| " + " | ".join(self._cells(row)) + " |\n")
+            self.out.write(self._line("-"))
+
+    def stream(self, rows):
+        """Write all rows from an iterable. Returns the number of rows written."""
+        rows = iter(rows)
+        head = list(islice(rows, self.sample))
+        if not head:
+            return 0
+        self.fit(head)
+        self.write_header()
+        count = 0
+        for row in chain(head, rows):
+            self.write_row(row)
+            count += 1
+        self.out.flush()
+        return count
+
+    def page(self, rows, page_size=None):
+        """Interactive pager over a list of rows."""
+        page_size = page_size or PAGE_SIZE
+        pages = (len(rows) + page_size - 1) // page_size
+        self.fit(rows[: self.sample])
+        page = 0
+        while True:
+            self.write_header()
+            for row in rows[page * page_size : (page + 1) * page_size]:
+                self.write_row(row)
+            self.out.flush()
+            choice = (
+                input(
+                    f"Page {page + 1}/{pages} ({len(rows)} rows) - "
+                    "[Enter] next, p previous, page number, q quit: "
+                )
+                .strip()
+                .lower()
+            )
+            if choice == "q":
+                break
+            elif choice == "p":
+                page = max(page - 1, 0)
+            elif choice.isdigit() and 1 <= int(choice) <= pages:
+                page = int(choice) - 1
+            elif choice == "":
+                if page + 1 >= pages:
+                    break
+                page += 1
+
+
+def show_table(users, status="expired", fmt=None, paged=True, usage=None, tagged=False):
+    """
+    Print users as a table. `users` may be any iterable; rows are written as
+    they are produced. On a terminal, long lists are shown one page at a time.
+    usage: add up/down/all-time columns (default: XUIM_SHOW_USAGE); only
+    for USER_STATUSES.
+    tagged: users are (source, user) pairs; a first column shows the source.
+    """
+    columns = TABLE_COLUMNS.get(status, TABLE_COLUMNS[None])
+    if usage is None:
+        usage = SHOW_USAGE
+    if usage and status in USER_STATUSES:
+        if status not in USAGE_STATUSES and not tagged:
+            users = attach_usage(list(users))
+        columns = columns + USAGE_COLUMNS
+    if tagged:
+        columns = [("DB", lambda pair: pair[0])] + [
+            (header, lambda pair, get=get: get(pair[1])) for header, get in columns
+        ]
+    writer = TableWriter([c[0] for c in columns], fmt=fmt or TABLE_FORMAT)
+    rows = ([get(u) for _, get in columns] for u in users)
+
+    if paged and isinstance(users, list) and len(users) > PAGE_SIZE:
+        if sys.stdin.isatty() and sys.stdout.isatty():
+            writer.page(list(rows))
+            return
+
+    with phase("render"):
+        written = writer.stream(rows)
+    count("rows_rendered", written)
+    if not written:
         print(f"No {status} users found.")
-        return
-    table = []
-    if status == "expired":
+
+
+# ------------------------- Export ------------------------- #
+EXPORT_FIELDS = (
+    "inbound_id",
+    "port",
+    "email",
+    "expiryTime",
+    "enable",
+    "total",
+    "up",
+    "down",
+    "all_time",
+    "days_expired",
+)
+EXPORT_USAGE_FIELDS = {"up", "down", "all_time"}
+
+
+def export_users(users, fmt="csv", path=None, usage=True):
+    """
+    Write users as CSV or JSON Lines to `path` (stdout when empty or "-").
+    `users` may be any iterable; rows are written as they arrive and flushed
+    every EXPORT_FLUSH_ROWS rows, so output can be piped into jq or gzip.
+    usage=False leaves out the up/down/all_time fields.
+    Returns the number of rows written.
+    """
+    import csv
+
+    fields = [f for f in EXPORT_FIELDS if usage or f not in EXPORT_USAGE_FIELDS]
+
+    to_stdout = not path or path == "-"
+    out = sys.stdout if to_stdout else open(path, "w", newline="", encoding="utf-8")
+    rows = 0
+    try:
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(fields)
         for u in users:
-            exp_date = time.strftime(
-                "%Y-%m-%d %H:%M:%S", time.localtime(u["expiryTime"])
+            record = u.as_dict(usage)
+            if fmt == "csv":
+                writer.writerow([record.get(k, "") for k in fields])
+            else:
+                out.write(json_dumps(record) + "\n")
+            rows += 1
+            if rows % EXPORT_FLUSH_ROWS == 0:
+                out.flush()
+        out.flush()
+    finally:
+        if not to_stdout:
+            out.close()
+    count("rows_exported", rows)
+    return rows
+
+
+# ------------------------- Update Client Traffic ------------------------- #
+def read_traffic_file(path, unit="gb"):
+    """
+    Yield (email, down, up) in bytes from a CSV file with email,down,up
+    columns (header optional) or a JSON Lines file (.jsonl/.json) with
+    email, down and up keys. `unit` is "gb" or "bytes".
+    """
+    import csv
+
+    scale = GB if unit == "gb" else 1
+
+    def csv_rows(f):
+        reader = csv.reader(f)
+        for row in reader:
+            if row and row[0].strip():
+                yield reader.line_num, row
+
+    def jsonl_rows(f):
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                r = json_loads(line)
+            except ValueError:
+                raise ValueError(f"{path}:{line_no}: invalid JSON") from None
+            if not isinstance(r, dict) or "email" not in r:
+                raise ValueError(f"{path}:{line_no}: expected email, down and up keys")
+            yield line_no, [r["email"], r.get("down", 0), r.get("up", 0)]
+
+    with open(path, newline="", encoding="utf-8") as f:
+        is_jsonl = path.endswith((".jsonl", ".json"))
+        first = not is_jsonl  # only CSV may start with a header
+        for line_no, row in jsonl_rows(f) if is_jsonl else csv_rows(f):
+            if len(row) != 3:
+                raise ValueError(f"{path}:{line_no}: expected email,down,up")
+            email, down, up = row
+            try:
+                down, up = float(down or 0), float(up or 0)
+            except (TypeError, ValueError):
+                if first:
+                    first = False
+                    continue  # header
+                raise ValueError(f"{path}:{line_no}: invalid traffic value")
+            first = False
+            yield str(email).strip(), int(down * scale), int(up * scale)
+
+
+def import_traffic(records):
+    """
+    Set absolute download/upload bytes for many clients at once.
+    records: iterable of (email, down, up); the last value for an email wins.
+    Every affected inbound is decoded and rewritten once and client_traffics
+    is updated with executemany in the same short transaction; all_time moves
+    by the same delta as up + down. Emails with no client in any inbound are
+    skipped and reported as missing.
+    """
+    targets = {email: (down, up) for email, down, up in records if email}
+    summary = {"updated": 0, "inserted": 0, "missing": [], "inbounds": 0}
+    if not targets:
+        return summary
+
+    found = {}
+
+    def transform(inbound_id, port, settings):
+        seen = {}
+        for client in settings.get("clients") or []:
+            email = client_email(client)
+            if email not in targets:
+                continue
+            down, up = targets[email]
+            seen.setdefault(email, client.get("enable", True))
+            delta = (up - client.get("up", 0)) + (down - client.get("down", 0))
+            client["up"] = up
+            client["down"] = down
+            client["all_time"] = max(client.get("all_time", 0) + delta, 0)
+        return seen
+
+    def finish(cursor, written):
+        batch = {}
+        for inbound_id, seen in written.items():
+            for email, enable in seen.items():
+                if email not in found:
+                    batch[email] = found[email] = (inbound_id, enable)
+        load_temp_keys(cursor, batch)
+        cursor.execute(
+            "SELECT email, down, up, all_time FROM client_traffics "
+            "WHERE email IN (SELECT email FROM temp.xuim_keys)"
+        )
+        current = {row[0]: row[1:] for row in cursor.fetchall()}
+        updates, inserts = [], []
+        for email, (inbound_id, enable) in batch.items():
+            down, up = targets[email]
+            if email in current:
+                current_down, current_up, current_all_time = current[email]
+                delta = (up - current_up) + (down - current_down)
+                new_all_time = max((current_all_time or 0) + delta, 0)
+                updates.append((down, up, new_all_time, email))
+            else:
+                inserts.append((inbound_id, enable, email, down, up, down + up))
+        with phase("sql"):
+            cursor.executemany(
+                "UPDATE client_traffics SET down=?, up=?, all_time=? WHERE email=?",
+                updates,
             )
-            table.append([u["email"], u["port"], exp_date, u["days_expired"]])
-        print(
-            tabulate(
-                table,
-                headers=["Email", "Port", "Expiry Time", "Days Expired"],
-                tablefmt="grid",
+        with phase("sql"):
+            cursor.executemany(
+                "INSERT INTO client_traffics "
+                "(inbound_id, enable, email, down, up, all_time) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                inserts,
             )
+        count("rows_written", len(updates) + len(inserts))
+        summary["updated"] += len(updates)
+        summary["inserted"] += len(inserts)
+        summary["inbounds"] += len(written)
+
+    auto_backup("traffic")
+    mutate_inbounds(transform, locate_inbounds(targets), finish=finish)
+    summary["missing"] = sorted(set(targets) - set(found))
+    return summary
+
+
+def print_traffic_summary(summary):
+    print(
+        f"✅ Traffic rows updated: {summary['updated']}, inserted: "
+        f"{summary['inserted']}, inbounds rewritten: {summary['inbounds']} "
+        f"{write_report()}"
+    )
+    if summary["missing"]:
+        shown = ", ".join(summary["missing"][:20])
+        more = len(summary["missing"]) - 20
+        print(
+            f"❌ {len(summary['missing'])} emails not found in any inbound: {shown}"
+            + (f" ... and {more} more" if more > 0 else "")
         )
-    elif status == "not_started":
-        for u in users:
-            table.append([u["email"], u["port"], "Not started"])
-        print(tabulate(table, headers=["Email", "Port", "Status"], tablefmt="grid"))
-    else:
-        for u in users:
-            table.append([u["email"], u["port"]])
-        print(tabulate(table, headers=["Email", "Port"], tablefmt="grid"))
 
 
-# ------------------------- Update Client Traffic ------------------------- #
+def set_client_traffic(email, down, up):
+    """Set absolute download/upload bytes for one client."""
+    return import_traffic([(email, down, up)])
+
+
 def update_client_traffic():
     print("\n\033[1;36mUpdate Client Traffic (Upload & Download)\033[0m\n")
-    conn = connect_db()
-    cursor = conn.cursor()
+    idx = menu_select(
+        ["Update One Client", "Bulk Import From CSV/JSONL File"],
+        "Update Client Traffic",
+    )
+    if idx == 0:
+        return
+    if idx == 2:
+        path = input("File path (email,down,up per line): ").strip()
+        unit = input("Values are in GB or bytes? (gb/bytes, default gb): ").strip()
+        try:
+            with traced("Bulk Import Traffic"):
+                records = read_traffic_file(path, "bytes" if unit == "bytes" else "gb")
+                print_traffic_summary(import_traffic(records))
+        except Exception as e:
+            print(f"❌ Failed to import traffic: {e}")
+        return
 
     while True:
         email = input("Enter client email (or 0 to go back): ").strip()
@@ -345,145 +2114,511 @@ def update_client_traffic():
             down_gb = input("Enter download traffic in GB: ").strip()
             up_gb = input("Enter upload traffic in GB: ").strip()
 
-            down = int(float(down_gb) * 1073741824) if down_gb else 0
-            up = int(float(up_gb) * 1073741824) if up_gb else 0
+            down = int(float(down_gb) * GB) if down_gb else 0
+            up = int(float(up_gb) * GB) if up_gb else 0
 
-            cursor.execute(
-                "SELECT down, up, all_time FROM client_traffics WHERE email=?",
-                (email,),
+            with traced("Update Client Traffic"):
+                summary = set_client_traffic(email, down, up)
+            if summary["missing"]:
+                print(f"❌ No client with email {email} found.")
+                continue
+            print(
+                f"✅ Updated traffic for {email} (Down: {down_gb} GB, Up: {up_gb} GB) "
+                f"{write_report()}"
             )
-            row = cursor.fetchone()
-            if row:
-                current_down, current_up, current_all_time = row
-                delta = (up - current_up) + (down - current_down)
-                new_all_time = max(current_all_time + delta, 0)
 
-                cursor.execute(
-                    "UPDATE client_traffics SET down=?, up=?, all_time=? WHERE email=?",
-                    (down, up, new_all_time, email),
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO client_traffics (email, down, up, all_time) VALUES (?, ?, ?, ?)",
-                    (email, down, up, down + up),
-                )
+        except Exception as e:
+            print(f"❌ Failed to update traffic: {e}")
 
-            cursor.execute("SELECT id, settings FROM inbounds")
-            inbounds = cursor.fetchall()
-            for inbound_id, settings in inbounds:
-                try:
-                    settings_json = json.loads(settings)
-                    modified = False
-                    if "clients" in settings_json:
-                        for client in settings_json["clients"]:
-                            if client.get("email") == email:
-                                current_client_up = client.get("up", 0)
-                                current_client_down = client.get("down", 0)
-                                current_client_all_time = client.get("all_time", 0)
-
-                                delta_client = (up - current_client_up) + (
-                                    down - current_client_down
-                                )
-                                client["up"] = down
-                                client["down"] = up
-                                client["all_time"] = max(
-                                    current_client_all_time + delta_client, 0
-                                )
-                                modified = True
-                    if modified:
-                        cursor.execute(
-                            "UPDATE inbounds SET settings=? WHERE id=?",
-                            (json.dumps(settings_json, ensure_ascii=False), inbound_id),
-                        )
-                except Exception:
-                    continue
 
-            conn.commit()
-            print(
-                f"✅ Updated traffic for {email} (Down: {down_gb} GB, Up: {up_gb} GB)"
+# ------------------------- Give Days ------------------------- #
+
+
+def client_predicate(
+    name=None, regex=None, min_days_left=None, max_days_left=None, enabled=None
+):
+    """
+    Build a predicate(client, now) for shift_expiry. name is a substring,
+    regex is matched with re.search; both are case-insensitive. The days-left
+    window is inclusive. enabled=None accepts both states.
+    Raises ValueError for an invalid regex.
+    """
+    name = name.lower() if name else None
+    try:
+        pattern = re.compile(regex, re.IGNORECASE) if regex else None
+    except re.error as e:
+        raise ValueError(f"invalid regex {regex!r}: {e}") from None
+
+    def match(client, now):
+        email = client_email(client)
+        if name and name not in email.lower():
+            return False
+        if pattern and not pattern.search(email):
+            return False
+        if enabled is not None and bool(client.get("enable", True)) != enabled:
+            return False
+        if min_days_left is not None or max_days_left is not None:
+            days_left = ((client.get("expiryTime", 0) or 0) // 1000 - now) // DAY
+            if min_days_left is not None and days_left < min_days_left:
+                return False
+            if max_days_left is not None and days_left > max_days_left:
+                return False
+        return True
+
+    return match
+
+
+def shift_expiry(days, inbound_ids=None, match=None, dry_run=False):
+    """
+    Move the expiry of non-expired clients accepted by `match` by `days`
+    (negative subtracts, never below now). Selected inbounds are loaded with
+    one query and all changes commit in one short transaction; with dry_run
+    nothing is written. The reference time is taken when the call starts.
+    Returns the changes as dicts: email, inbound_id, port, old_expiry, new_expiry.
+    """
+    now = int(time.time())
+
+    def transform(inbound_id, port, settings):
+        changes = []
+        for client in settings.get("clients") or []:
+            expiry_sec = (client.get("expiryTime", 0) or 0) // 1000
+            if expiry_sec <= now:
+                continue
+            if match and not match(client, now):
+                continue
+            new_expiry_sec = max(expiry_sec + days * DAY, now)
+            client["expiryTime"] = new_expiry_sec * 1000
+            changes.append(
+                {
+                    "email": client_email(client),
+                    "inbound_id": inbound_id,
+                    "port": port,
+                    "old_expiry": expiry_sec,
+                    "new_expiry": new_expiry_sec,
+                }
             )
+        return changes
+
+    if not dry_run:
+        auto_backup("days")
+    results = mutate_inbounds(transform, inbound_ids, dry_run=dry_run)
+    return [change for i in sorted(results) for change in results[i]]
+
+
+def print_shift_summary(changes, days, dry_run):
+    per_inbound = {}
+    for c in changes:
+        per_inbound[c["inbound_id"]] = per_inbound.get(c["inbound_id"], 0) + 1
+    for inbound_id, count in sorted(per_inbound.items()):
+        print(f"  Inbound {inbound_id}: {count} clients")
+    if dry_run:
+        print(f"Dry run: {len(changes)} clients would move by {days} days.")
+    else:
+        print(
+            f"✅ Updated expiry of {len(changes)} clients by {days} days. "
+            f"{write_report()}"
+        )
 
-        except Exception as e:
-            print(f"❌ Failed to update traffic: {e}")
 
-    conn.close()
+def give_days_to_clients():
+    print("\n\033[1;36mGive / Subtract Days To Clients\033[0m\n")
+    inbound_selected = select_inbound()
+    inbound_ids = [inbound_selected] if inbound_selected else None
+
+    while True:
+        options = [
+            "Add days to all non-expired clients",
+            "Add days to non-expired clients containing a name",
+            "Subtract days from all non-expired clients",
+            "Subtract days from non-expired clients containing a name",
+        ]
+        idx = menu_select(options, "Give Days To Clients")
+        if idx == 0:
+            break
+
+        days_input = input("Enter number of days: ").strip()
+        if not days_input.isdigit():
+            print("Invalid number of days.")
+            continue
+        days = int(days_input)
+
+        match = None
+        if idx in [3, 4]:
+            days = -days
+        if idx == 2 or idx == 4:
+            name_filter = input("Enter name substring to filter (or /regex/): ").strip()
+            try:
+                if len(name_filter) > 2 and name_filter[0] == name_filter[-1] == "/":
+                    match = client_predicate(regex=name_filter[1:-1])
+                else:
+                    match = client_predicate(name=name_filter)
+            except ValueError as e:
+                print(f"❌ {e}")
+                continue
+
+        with traced(options[idx - 1]):
+            try:
+                changes = shift_expiry(days, inbound_ids, match, dry_run=True)
+                if not changes:
+                    print("No matching non-expired clients.")
+                    continue
+                show_table(changes, status="expiry_shift")
+                print_shift_summary(changes, days, dry_run=True)
+                if input("Apply these changes? (yes/no): ").strip().lower() != "yes":
+                    continue
+                changes = shift_expiry(days, inbound_ids, match)
+                print_shift_summary(changes, days, dry_run=False)
+
+            except Exception as e:
+                print(f"❌ Failed to update clients: {e}")
+
+
+# ------------------------- Enable / Disable Users ------------------------- #
+def set_users_enabled(users, enable=True):
+    """
+    Enable or disable users in bulk.
+    users: client records (.email and .inbound_id; inbound_id None matches
+    any inbound).
+    Targets are grouped by inbound; each inbound is decoded once, every
+    matching client is flipped and the inbound is written once. The enable
+    column of client_traffics is kept in sync in the same transaction.
+    Returns the number of clients changed.
+    """
+    targets = {}
+    for u in users:
+        if u.email and u.email != "<no-email>":
+            targets.setdefault(u.inbound_id, set()).add(u.email)
+    if not targets:
+        return 0
+
+    any_inbound = targets.pop(None, set())
+    changed_emails = set()
+
+    def transform(inbound_id, port, settings):
+        emails = targets.get(inbound_id, set()) | any_inbound
+        changed = set()
+        for c in settings.get("clients") or []:
+            if bool(c.get("enable", True)) == enable:
+                continue
+            email = client_email(c)
+            if email in emails:
+                c["enable"] = enable
+                changed.add(email)
+        return changed
+
+    def finish(cursor, written):
+        emails = set(chain.from_iterable(written.values()))
+        load_temp_keys(cursor, emails)
+        cursor.execute(
+            "UPDATE client_traffics SET enable=? "
+            "WHERE email IN (SELECT email FROM temp.xuim_keys)",
+            (enable,),
+        )
+        changed_emails.update(emails)
+
+    auto_backup("enable" if enable else "disable")
+    if any_inbound:
+        inbound_ids = locate_inbounds(any_inbound)
+        if inbound_ids is not None:
+            inbound_ids = sorted(set(inbound_ids) | set(targets))
+    else:
+        inbound_ids = list(targets)
+    mutate_inbounds(transform, inbound_ids, finish=finish)
+    return len(changed_emails)
+
+
+def enable_users(users):
+    """Enable the given inactive users. Returns the number of users enabled."""
+    return set_users_enabled(users, True)
+
+
+def disable_users(users):
+    """Disable the given users. Returns the number of users disabled."""
+    return set_users_enabled(users, False)
+
+
+# ------------------------- Reconciliation ------------------------- #
+def reconcile():
+    """
+    Compare the clients of all inbounds (one snapshot scan) with the rows of
+    client_traffics (one query) using set operations, in linear time.
+    Returns a report dict:
+      orphan_traffic: emails with a traffic row but no client
+      missing_traffic: emails of clients without a traffic row
+      duplicates: {email: [inbound ids]} for emails used more than once
+        (clients without email or id are never duplicates of each other)
+      clients, traffic_rows: totals
+    """
+    clients = get_snapshot().clients
+    with phase("sql"):
+        traffic = {
+            r[0] for r in get_db().reader.execute("SELECT email FROM client_traffics")
+        }
+    with phase("filter"):
+        seen = {}
+        for c in clients:
+            seen.setdefault(c.email, []).append(c.inbound_id)
+        emails = set(seen)
+        report = {
+            "clients": len(clients),
+            "traffic_rows": len(traffic),
+            "orphan_traffic": sorted(traffic - emails),
+            "missing_traffic": sorted(emails - traffic - {"<no-email>"}),
+            "duplicates": {
+                e: ids for e, ids in seen.items() if len(ids) > 1 and e != "<no-email>"
+            },
+        }
+    return report
+
+
+def print_reconcile_report(report):
+    print(
+        f"Clients: {report['clients']}, traffic rows: {report['traffic_rows']}\n"
+        f"  Traffic rows without a client: {len(report['orphan_traffic'])}\n"
+        f"  Clients without a traffic row: {len(report['missing_traffic'])}\n"
+        f"  Emails used more than once:    {len(report['duplicates'])}"
+    )
+    for title, emails in (
+        ("Orphan traffic", report["orphan_traffic"]),
+        ("Missing traffic", report["missing_traffic"]),
+        ("Duplicates", list(report["duplicates"])),
+    ):
+        if emails:
+            more = f" ... and {len(emails) - 20} more" if len(emails) > 20 else ""
+            print(f"{title}: {', '.join(emails[:20])}{more}")
 
 
-# ------------------------- Give Days ------------------------- #
+def repair(report, dedupe=False):
+    """
+    Fix what reconcile() found in one batched transaction: delete traffic
+    rows without a client and add empty rows for clients without one.
+    dedupe: also keep only the first client of each duplicated email (lowest
+    inbound id, first position) and remove the others; the affected inbounds
+    are rewritten in the same transaction.
+    Returns counts: deleted_rows, inserted_rows, removed_duplicates.
+    """
+    result = {"deleted_rows": 0, "inserted_rows": 0, "removed_duplicates": 0}
+    missing = set(report["missing_traffic"])
+    rows = []
+    for c in get_snapshot().clients:
+        if c.email in missing:
+            missing.discard(c.email)
+            rows.append(
+                (c.inbound_id, c.enable, c.email, 0, 0, 0, c.expiry_ms, c.total)
+            )
+    pending = bool(report["orphan_traffic"] or rows)
+
+    def fix_traffic(cursor, written=None):
+        nonlocal pending
+        if not pending:
+            return
+        result["deleted_rows"] = delete_traffic_rows(cursor, report["orphan_traffic"])
+        with phase("sql"):
+            cursor.executemany(
+                "INSERT INTO client_traffics "
+                "(inbound_id, enable, email, up, down, all_time, expiry_time, total) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        result["inserted_rows"] = len(rows)
+        count("rows_written", result["deleted_rows"] + len(rows))
+        pending = False
+
+    auto_backup("repair")
+    stats = new_write_stats()
+    duplicates = report["duplicates"] if dedupe else {}
+    if duplicates:
+        keeper = {
+            email: min(ids)
+            for email, ids in duplicates.items()
+            if email != "<no-email>"
+        }
+
+        def transform(inbound_id, port, settings):
+            kept, removed, seen = [], 0, set()
+            for c in settings.get("clients") or []:
+                email = client_email(c)
+                if email in keeper and (keeper[email] != inbound_id or email in seen):
+                    removed += 1
+                    continue
+                seen.add(email)
+                kept.append(c)
+            settings["clients"] = kept
+            return removed
+
+        inbound_ids = sorted(set(chain.from_iterable(duplicates.values())))
+        written = mutate_inbounds(transform, inbound_ids, finish=fix_traffic)
+        result["removed_duplicates"] = sum(written.values())
+        stats = get_db().last_write
+    if pending:
+        with get_db().write() as cursor:
+            fix_traffic(cursor)
+        note_transaction(stats)
+        invalidate_snapshot()
+    return result
+
+
+def print_repair_result(result):
+    print(
+        f"✅ Deleted {result['deleted_rows']} orphan traffic rows, added "
+        f"{result['inserted_rows']} missing rows, removed "
+        f"{result['removed_duplicates']} duplicate clients. {write_report()}"
+    )
 
 
-def give_days_to_clients():
-    print("\n\033[1;36mGive / Subtract Days To Clients\033[0m\n")
-    inbounds_selected = select_inbound()
-    if inbounds_selected is None:
-        inbounds_ids = [i[0] for i in list_inbounds()]
-    else:
-        inbounds_ids = [inbounds_selected]
+# ------------------------- Watch ------------------------- #
+class Watcher:
+    """
+    Applies cleanup policies whenever the database changes or a client
+    crosses a time threshold. An idle tick costs one PRAGMA data_version and
+    two stat() calls; after a change only inbounds whose settings hash moved
+    (or whose next expiry deadline passed) are evaluated again.
+    delete_expired: days past expiry before a client is deleted (None = off).
+    where: optional CompiledQuery every policy is limited to.
+    """
 
-    while True:
-        options = [
-            "Add days to all non-expired clients",
-            "Add days to non-expired clients containing a name",
-            "Subtract days from all non-expired clients",
-            "Subtract days from non-expired clients containing a name",
+    def __init__(
+        self,
+        delete_expired=None,
+        disable_over_quota=False,
+        enable_not_started=False,
+        where=None,
+        dry_run=False,
+    ):
+        self.delete_expired = delete_expired
+        self.disable_over_quota = disable_over_quota
+        self.enable_not_started = enable_not_started
+        self.where = where
+        self.dry_run = dry_run
+        self.version = None
+        self.hashes = {}
+        self.deadlines = {}
+        self.cycles = 0
+
+    def tick(self):
+        """Run a cycle if anything changed; returns its stats or None."""
+        snapshot = get_snapshot()
+        now = int(time.time())
+        due = min(self.deadlines.values(), default=float("inf"))
+        if snapshot.version == self.version and snapshot.version and now < due:
+            return None
+        with traced("watch cycle"):
+            return self.cycle(snapshot, now)
+
+    def _deadline(self, clients, now):
+        if self.delete_expired is None:
+            return float("inf")
+        offset = self.delete_expired * DAY
+        deadlines = (c.expiry + offset for c in clients if c.expiry > 0)
+        return min((d for d in deadlines if d > now), default=float("inf"))
+
+    def cycle(self, snapshot, now):
+        started = time.perf_counter()
+        lock_before = get_db().total_lock_ms
+        scope = [
+            iid
+            for iid, entry in snapshot.inbounds.items()
+            if self.hashes.get(iid) != entry["hash"]
+            or self.deadlines.get(iid, 0) <= now
         ]
-        idx = menu_select(options, "Give Days To Clients")
-        if idx == 0:
-            break
-
-        days_input = input("Enter number of days: ").strip()
-        if not days_input.isdigit():
-            print("Invalid number of days.")
-            continue
-        days = int(days_input)
+        self.hashes = {iid: e["hash"] for iid, e in snapshot.inbounds.items()}
+        self.deadlines = {
+            iid: d for iid, d in self.deadlines.items() if iid in self.hashes
+        }
+
+        to_delete, to_enable, to_disable = [], [], []
+        over_quota = set()
+        if self.disable_over_quota:
+            # Traffic changes do not touch settings, so check every quota.
+            quota = [c for c in snapshot.clients if c.total > 0]
+            quota = filter_users(attach_usage(quota), self.where)
+            over_quota = {c.email for c in quota if c.up + c.down >= c.total}
+            to_disable = [c for c in quota if c.enable and c.email in over_quota]
+        for iid in scope:
+            clients = filter_users(snapshot.select(iid), self.where)
+            self.deadlines[iid] = self._deadline(clients, now)
+            for c in clients:
+                if (
+                    self.delete_expired is not None
+                    and 0 < c.expiry < now
+                    and c.days_expired(now) >= self.delete_expired
+                ):
+                    to_delete.append(c)
+                elif (
+                    self.enable_not_started
+                    and c.expiry < 0
+                    and not c.enable
+                    and c.email not in over_quota
+                ):
+                    to_enable.append(c)
+
+        done = {"deleted": 0, "disabled": 0, "enabled": 0}
+        failed = False
+        if not self.dry_run:
+            try:
+                if to_delete:
+                    deleted = delete_users(to_delete)
+                    # delete_users() reports its own errors and returns None.
+                    failed = deleted is None
+                    done["deleted"] = deleted or 0
+                if to_disable:
+                    done["disabled"] = disable_users(to_disable)
+                if to_enable:
+                    done["enabled"] = enable_users(to_enable)
+            except Exception as e:
+                print(f"❌ Watch action failed: {e}", flush=True)
+                failed = True
+        self.version = snapshot.version
+        if failed:
+            # Evaluate everything again on the next tick.
+            self.version = None
+            self.hashes = {}
+            self.deadlines = {}
+        self.cycles += 1
+
+        stats = {
+            "cycle": self.cycles,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "inbounds": len(scope),
+            "delete": len(to_delete),
+            "disable": len(to_disable),
+            "enable": len(to_enable),
+            "write_lock_ms": round(get_db().total_lock_ms - lock_before, 1),
+            **done,
+        }
+        if self.dry_run:
+            actions = (
+                f"would delete {len(to_delete)}, disable {len(to_disable)}, "
+                f"enable {len(to_enable)}"
+            )
+        else:
+            actions = (
+                f"deleted {done['deleted']}, disabled {done['disabled']}, "
+                f"enabled {done['enabled']}"
+            )
+        print(
+            f"[{format_time(now)}] cycle {stats['cycle']}: {stats['ms']} ms, "
+            f"{stats['inbounds']} inbounds evaluated, {actions}"
+            f"{', failed' if failed else ''}, "
+            f"write lock {stats['write_lock_ms']} ms",
+            flush=True,
+        )
+        return stats
 
-        name_filter = None
-        if idx in [3, 4]:
-            days = -days
-        if idx == 2 or idx == 4:
-            name_filter = input("Enter name substring to filter: ").strip()
 
-        conn = connect_db()
-        cursor = conn.cursor()
-        try:
-            for inbound_id in inbounds_ids:
-                cursor.execute(
-                    "SELECT id, settings FROM inbounds WHERE id=?", (inbound_id,)
-                )
-                row = cursor.fetchone()
-                if not row:
-                    continue
-                inbound_id_row, settings_json = row
-                settings = json.loads(settings_json)
-                modified = False
-                clients = settings.get("clients") or []
-
-                for client in clients:
-                    expiry_ms = client.get("expiryTime", 0) or 0
-                    expiry_sec = expiry_ms // 1000
-                    if expiry_sec <= now:
-                        continue
-                    email = client.get("email") or client.get("id") or "<no-email>"
-                    if name_filter and name_filter.lower() not in email.lower():
-                        continue
-                    new_expiry_sec = expiry_sec + days * 24 * 3600
-                    if new_expiry_sec < now:
-                        new_expiry_sec = now
-                    client["expiryTime"] = new_expiry_sec * 1000
-                    modified = True
-
-                if modified:
-                    cursor.execute(
-                        "UPDATE inbounds SET settings=? WHERE id=?",
-                        (json.dumps(settings, ensure_ascii=False), inbound_id_row),
-                    )
-            conn.commit()
-            print(f"✅ Updated expiry for applicable clients by {days} days.")
+def watch(watcher, interval=60, once=False):
+    """Tick every `interval` seconds until interrupted (Ctrl+C or SIGTERM)."""
+    import signal
 
-        except Exception as e:
-            print(f"❌ Failed to update clients: {e}")
-        finally:
-            conn.close()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            watcher.tick()
+            if once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print(f"Watch stopped after {watcher.cycles} cycles.", flush=True)
 
 
 # ------------------------- Menus ------------------------- #
@@ -501,52 +2636,55 @@ def expired_users_menu():
         idx = menu_select(options, "Expired Users Management")
         if idx == 0:
             break
-        elif idx == 1:
-            users = get_expired_users(inbound_id=inbound_id)
-            show_table(users)
-        elif idx == 2:
-            name = input("Enter name substring: ").strip()
-            users = get_expired_users(name=name, inbound_id=inbound_id)
-            show_table(users)
-        elif idx == 3:
-            days = input("Days (default 30): ").strip()
-            days = int(days) if days.isdigit() else 30
-            users = get_expired_users(days=days, inbound_id=inbound_id)
-            show_table(users)
-        elif idx == 4:
-            users = get_expired_users(inbound_id=inbound_id)
-            show_table(users)
-            if (
-                users
-                and input("Delete all expired users? (yes/no): ").strip().lower()
-                == "yes"
-            ):
-                delete_users(users)
-        elif idx == 5:
-            name = input("Enter name substring: ").strip()
-            users = get_expired_users(name=name, inbound_id=inbound_id)
-            show_table(users)
-            if (
-                users
-                and input(f"Delete expired users containing '{name}'? (yes/no): ")
-                .strip()
-                .lower()
-                == "yes"
-            ):
-                delete_users(users)
-        elif idx == 6:
-            days = input("Days (default 30): ").strip()
-            days = int(days) if days.isdigit() else 30
-            users = get_expired_users(days=days, inbound_id=inbound_id)
-            show_table(users)
-            if (
-                users
-                and input(f"Delete expired users older than {days} days? (yes/no): ")
-                .strip()
-                .lower()
-                == "yes"
-            ):
-                delete_users(users)
+        with traced(options[idx - 1]):
+            if idx == 1:
+                users = get_expired_users(inbound_id=inbound_id)
+                show_table(users)
+            elif idx == 2:
+                name = input("Enter name substring: ").strip()
+                users = get_expired_users(name=name, inbound_id=inbound_id)
+                show_table(users)
+            elif idx == 3:
+                days = input("Days (default 30): ").strip()
+                days = int(days) if days.isdigit() else 30
+                users = get_expired_users(days=days, inbound_id=inbound_id)
+                show_table(users)
+            elif idx == 4:
+                users = get_expired_users(inbound_id=inbound_id)
+                show_table(users)
+                if (
+                    users
+                    and input("Delete all expired users? (yes/no): ").strip().lower()
+                    == "yes"
+                ):
+                    delete_users(users)
+            elif idx == 5:
+                name = input("Enter name substring: ").strip()
+                users = get_expired_users(name=name, inbound_id=inbound_id)
+                show_table(users)
+                if (
+                    users
+                    and input(f"Delete expired users containing '{name}'? (yes/no): ")
+                    .strip()
+                    .lower()
+                    == "yes"
+                ):
+                    delete_users(users)
+            elif idx == 6:
+                days = input("Days (default 30): ").strip()
+                days = int(days) if days.isdigit() else 30
+                users = get_expired_users(days=days, inbound_id=inbound_id)
+                show_table(users)
+                if (
+                    users
+                    and input(
+                        f"Delete expired users older than {days} days? (yes/no): "
+                    )
+                    .strip()
+                    .lower()
+                    == "yes"
+                ):
+                    delete_users(users)
 
 
 def not_started_menu():
@@ -560,36 +2698,39 @@ def not_started_menu():
         idx = menu_select(options, "Not-started Users Management")
         if idx == 0:
             break
-        elif idx == 1:
-            users = get_not_started_users(inbound_id=inbound_id)
-            show_table(users, status="not_started")
-        elif idx == 2:
-            name = input("Enter name substring: ").strip()
-            users = [
-                u
-                for u in get_not_started_users(inbound_id=inbound_id)
-                if name.lower() in (u["email"] or "").lower()
-            ]
-            show_table(users, status="not_started")
-            if (
-                users
-                and input(f"Delete not-started users containing '{name}'? (yes/no): ")
-                .strip()
-                .lower()
-                == "yes"
-            ):
-                delete_users(users)
-        elif idx == 3:
-            users = get_not_started_users(inbound_id=inbound_id)
-            show_table(users, status="not_started")
-            if (
-                users
-                and input("Delete ALL not-started users shown here? (yes/no): ")
-                .strip()
-                .lower()
-                == "yes"
-            ):
-                delete_users(users)
+        with traced(options[idx - 1]):
+            if idx == 1:
+                users = get_not_started_users(inbound_id=inbound_id)
+                show_table(users, status="not_started")
+            elif idx == 2:
+                name = input("Enter name substring: ").strip()
+                users = [
+                    u
+                    for u in get_not_started_users(inbound_id=inbound_id)
+                    if name.lower() in u.email.lower()
+                ]
+                show_table(users, status="not_started")
+                if (
+                    users
+                    and input(
+                        f"Delete not-started users containing '{name}'? (yes/no): "
+                    )
+                    .strip()
+                    .lower()
+                    == "yes"
+                ):
+                    delete_users(users)
+            elif idx == 3:
+                users = get_not_started_users(inbound_id=inbound_id)
+                show_table(users, status="not_started")
+                if (
+                    users
+                    and input("Delete ALL not-started users shown here? (yes/no): ")
+                    .strip()
+                    .lower()
+                    == "yes"
+                ):
+                    delete_users(users)
 
 
 def unlimited_menu():
@@ -599,55 +2740,174 @@ def unlimited_menu():
         idx = menu_select(options, "Unlimited Users Management")
         if idx == 0:
             break
-        elif idx == 1:
-            users = get_unlimited_users(inbound_id=inbound_id)
-            show_table(users, status="unlimited")
+        with traced(options[idx - 1]):
+            if idx == 1:
+                users = get_unlimited_users(inbound_id=inbound_id)
+                show_table(users, status="unlimited")
 
 
 def inactive_menu():
     inbound_id = select_inbound()
     while True:
-        options = ["Show All Inactive Users", "Enable All Inactive Users"]
+        options = [
+            "Show All Inactive Users",
+            "Enable All Inactive Users",
+            "Show Over-quota Users",
+            "Disable Over-quota Users",
+        ]
         idx = menu_select(options, "Inactive Users Management")
         if idx == 0:
             break
-        elif idx == 1:
-            users = get_inactive_users(inbound_id=inbound_id)
-            show_table(users, status="inactive")
-        elif idx == 2:
-            users = get_inactive_users(inbound_id=inbound_id)
-            # Enable logic
-            conn = connect_db()
-            cursor = conn.cursor()
-            enabled_count = 0
-            for u in users:
+        with traced(options[idx - 1]):
+            if idx == 1:
+                users = get_inactive_users(inbound_id=inbound_id)
+                show_table(users, status="inactive")
+            elif idx == 2:
+                users = get_inactive_users(inbound_id=inbound_id)
                 try:
-                    cursor.execute(
-                        "SELECT settings FROM inbounds WHERE port=?", (u["port"],)
-                    )
-                    row = cursor.fetchone()
-                    if not row:
-                        continue
-                    settings = json.loads(row[0])
-                    clients = settings.get("clients") or []
-                    changed = False
-                    for c in clients:
-                        if (c.get("email") or c.get("id")) == u["email"] and not c.get(
-                            "enable", True
-                        ):
-                            c["enable"] = True
-                            changed = True
-                    if changed:
-                        cursor.execute(
-                            "UPDATE inbounds SET settings=? WHERE port=?",
-                            (json.dumps(settings, ensure_ascii=False), u["port"]),
-                        )
-                        enabled_count += 1
-                except:
+                    enabled_count = enable_users(users)
+                    print(f"Enabled {enabled_count} users. {write_report()}")
+                except Exception as e:
+                    print(f"❌ Failed to enable users: {e}")
+            elif idx == 3:
+                users = get_over_quota_users(inbound_id=inbound_id)
+                show_table(users, status="over_quota")
+            elif idx == 4:
+                users = [
+                    u for u in get_over_quota_users(inbound_id=inbound_id) if u.enable
+                ]
+                show_table(users, status="over_quota")
+                if (
+                    users
+                    and input(f"Disable {len(users)} over-quota users? (yes/no): ")
+                    .strip()
+                    .lower()
+                    == "yes"
+                ):
+                    try:
+                        disabled_count = disable_users(users)
+                        print(f"Disabled {disabled_count} users. {write_report()}")
+                    except Exception as e:
+                        print(f"❌ Failed to disable users: {e}")
+
+
+def top_users_menu():
+    inbound_id = select_inbound()
+    while True:
+        options = ["Top Heavy Users", "Top Over-quota Users"]
+        idx = menu_select(options, "Traffic Reports")
+        if idx == 0:
+            break
+        limit = input("How many users? (default 10): ").strip()
+        if limit and not limit.isdigit():
+            print("❌ Please enter a number.")
+            continue
+        with traced(options[idx - 1]):
+            users = get_top_users(int(limit or 10), inbound_id, over_quota=idx == 2)
+            show_table(users, status="top")
+
+
+def query_menu():
+    inbound_id = select_inbound()
+    print(QUERY_HELP)
+    while True:
+        where = input("\nFilter (empty to go back): ").strip()
+        if not where:
+            break
+        try:
+            query = CompiledQuery(where)
+        except ValueError as e:
+            print(f"❌ {e}")
+            continue
+        with traced("Query Users"):
+            users = query(get_snapshot().select(inbound_id))
+            show_table(users, status="query")
+        if not users:
+            continue
+        options = [
+            "Delete Matching Users",
+            "Disable Matching Users",
+            "Enable Matching Users",
+        ]
+        idx = menu_select(options, f"{len(users)} Matching Users")
+        if idx == 0:
+            continue
+        if (
+            input(f"{options[idx - 1]} ({len(users)})? (yes/no): ").strip().lower()
+            != "yes"
+        ):
+            continue
+        with traced(options[idx - 1]):
+            try:
+                if idx == 1:
+                    delete_users(users)
                     continue
-            conn.commit()
-            conn.close()
-            print(f"Enabled {enabled_count} users.")
+                changed = set_users_enabled(users, idx == 3)
+                print(f"Changed {changed} users. {write_report()}")
+            except Exception as e:
+                print(f"❌ Failed to update users: {e}")
+
+
+def reconcile_menu():
+    while True:
+        with traced("Reconcile Report"):
+            report = reconcile()
+            print_reconcile_report(report)
+        options = [
+            "Repair Traffic Rows",
+            "Repair Traffic Rows And Remove Duplicate Clients",
+        ]
+        idx = menu_select(options, "Reconcile Clients & Traffic")
+        if idx == 0:
+            break
+        if input(f"{options[idx - 1]}? (yes/no): ").strip().lower() != "yes":
+            continue
+        with traced(options[idx - 1]):
+            try:
+                print_repair_result(repair(report, dedupe=idx == 2))
+            except Exception as e:
+                print(f"❌ Repair failed: {e}")
+
+
+def backup_menu():
+    while True:
+        options = [
+            "Create Backup Now",
+            "List Backups",
+            "Restore Backup",
+            "Compact Database (checkpoint + VACUUM)",
+        ]
+        idx = menu_select(options, f"Backup & Restore ({backup_dir()})")
+        if idx == 0:
+            break
+        try:
+            with traced(options[idx - 1]):
+                if idx == 1:
+                    create_backup()
+                elif idx == 2:
+                    show_table(list_backups(), status="backups")
+                elif idx == 3:
+                    backups = list_backups()
+                    if not backups:
+                        print("No backups found.")
+                        continue
+                    choices = [
+                        f"{os.path.basename(p)} ({size / 1048576:.1f} MB)"
+                        for p, size, _ in backups
+                    ]
+                    pick = menu_select(choices, "Select Backup To Restore")
+                    if pick == 0:
+                        continue
+                    path = backups[pick - 1][0]
+                    answer = input(
+                        f"Replace {current_db_path()} with {path}? (yes/no): "
+                    )
+                    if answer.strip().lower() == "yes":
+                        restore_backup(path)
+                elif idx == 4:
+                    compact_database()
+        except Exception as e:
+            print(f"❌ Backup operation failed: {e}")
 
 
 def uninstall_tool():
@@ -660,6 +2920,8 @@ def uninstall_tool():
         print("❌ Uninstall cancelled. Returning to main menu...")
         return
 
+    import subprocess
+
     try:
         print("🚀 Running uninstall script...")
         result = subprocess.run(
@@ -677,6 +2939,8 @@ def uninstall_tool():
 
 
 def update_tool():
+    import subprocess
+
     try:
         print("🚀 Running update script...")
         result = subprocess.run(
@@ -702,10 +2966,16 @@ def main_menu():
             "Inactive Users",
             "Update Client Traffic",
             "Give/Remove Days To Clients",
+            "Query Users (Filter Expression)",
+            "Traffic Reports (Top Users)",
+            "Reconcile Clients & Traffic",
+            "Backup & Restore",
             "Update X-UI Management Tool",
             "Uninstall X-UI Management Tool",
         ]
-        idx = menu_select(options, f"X-UI Management Tool {__version__}", gap_after=[6])
+        idx = menu_select(
+            options, f"X-UI Management Tool {__version__}", gap_after=[10]
+        )
         if idx == 0:
             print("You can use xuim for run it again.")
             sys.exit(0)
@@ -722,10 +2992,781 @@ def main_menu():
         elif idx == 6:
             give_days_to_clients()
         elif idx == 7:
-            update_tool()
+            query_menu()
         elif idx == 8:
+            top_users_menu()
+        elif idx == 9:
+            reconcile_menu()
+        elif idx == 10:
+            backup_menu()
+        elif idx == 11:
+            update_tool()
+        elif idx == 12:
             uninstall_tool()
 
 
+# ------------------------- CLI ------------------------- #
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_NOT_CONFIRMED = 3
+
+
+def usage_loaded(status, args):
+    """Whether up/down/all_time of the listed users hold real numbers."""
+    where = getattr(args, "where", None)
+    if isinstance(where, str):
+        where = CompiledQuery(where)
+    return bool(
+        getattr(args, "usage", False)
+        or status in USAGE_STATUSES
+        or (where and where.needs_usage)
+    )
+
+
+def print_users(users, status, args):
+    usage = args.usage or None
+    collect = getattr(_local, "collect", None)
+    if collect is not None:
+        # Fleet worker: the merged table/JSON is printed once at the end.
+        if usage and status not in USAGE_STATUSES:
+            attach_usage(users)
+        collect.append((status, list(users)))
+        return
+    if args.json:
+        if usage and status not in USAGE_STATUSES:
+            attach_usage(users)
+        loaded = usage_loaded(status, args)
+        print(json_dumps(users, default=lambda u: u.as_dict(loaded)))
+    else:
+        show_table(users, status=status, fmt=args.format, paged=False, usage=usage)
+
+
+def confirm_cli(args, prompt):
+    """--yes confirms; otherwise ask on a terminal and refuse when scripted."""
+    if args.yes:
+        return True
+    if getattr(_local, "output", None) is not None or not sys.stdin.isatty():
+        print("Refusing to modify the database without --yes.", file=sys.stderr)
+        return False
+    return input(f"{prompt} (yes/no): ").strip().lower() == "yes"
+
+
+def cli_expired(args):
+    users = get_expired_users(days=args.days, name=args.name, inbound_id=args.inbound)
+    users = filter_users(users, args.where)
+    if args.action == "list":
+        print_users(users, "expired", args)
+        return EXIT_OK
+    if not users:
+        print("No expired users found.")
+        return EXIT_OK
+    if not confirm_cli(args, f"Delete {len(users)} expired users?"):
+        return EXIT_NOT_CONFIRMED
+    return EXIT_OK if delete_users(users) is not None else EXIT_FAILURE
+
+
+def cli_not_started(args):
+    users = get_not_started_users(inbound_id=args.inbound)
+    if args.name:
+        users = [u for u in users if args.name.lower() in u.email.lower()]
+    users = filter_users(users, args.where)
+    if args.action == "list":
+        print_users(users, "not_started", args)
+        return EXIT_OK
+    if not users:
+        print("No not_started users found.")
+        return EXIT_OK
+    if not confirm_cli(args, f"Delete {len(users)} not-started users?"):
+        return EXIT_NOT_CONFIRMED
+    return EXIT_OK if delete_users(users) is not None else EXIT_FAILURE
+
+
+def cli_unlimited(args):
+    users = filter_users(get_unlimited_users(inbound_id=args.inbound), args.where)
+    print_users(users, "unlimited", args)
+    return EXIT_OK
+
+
+def cli_inactive(args):
+    users = filter_users(get_inactive_users(inbound_id=args.inbound), args.where)
+    if args.action == "list":
+        print_users(users, "inactive", args)
+        return EXIT_OK
+    if not users:
+        print("No inactive users found.")
+        return EXIT_OK
+    if not confirm_cli(args, f"Enable {len(users)} inactive users?"):
+        return EXIT_NOT_CONFIRMED
+    try:
+        enabled_count = enable_users(users)
+    except Exception as e:
+        print(f"❌ Failed to enable users: {e}")
+        return EXIT_FAILURE
+    print(f"Enabled {enabled_count} users.")
+    return EXIT_OK
+
+
+def cli_over_quota(args):
+    users = filter_users(get_over_quota_users(inbound_id=args.inbound), args.where)
+    if args.action == "list":
+        print_users(users, "over_quota", args)
+        return EXIT_OK
+    users = [u for u in users if u.enable]
+    if not users:
+        print("No enabled over-quota users found.")
+        return EXIT_OK
+    if not confirm_cli(args, f"Disable {len(users)} over-quota users?"):
+        return EXIT_NOT_CONFIRMED
+    try:
+        disabled_count = disable_users(users)
+    except Exception as e:
+        print(f"❌ Failed to disable users: {e}")
+        return EXIT_FAILURE
+    print(f"Disabled {disabled_count} users.")
+    return EXIT_OK
+
+
+def cli_top(args):
+    users = get_top_users(args.limit, args.inbound, args.over_quota, args.where)
+    print_users(users, "top", args)
+    return EXIT_OK
+
+
+# Base filter of each list command when its users are streamed for export.
+EXPORT_QUERIES = {
+    "expired": "expired",
+    "not-started": "not_started",
+    "unlimited": "unlimited",
+    "inactive": "disabled",
+    "over-quota": "over_quota",
+    "top": None,
+    "users": None,
+}
+
+
+def cli_export(args):
+    """
+    Export what a list command would show as a generator pipeline: inbound
+    scan -> filters -> (top-N heap) -> writer, in constant memory.
+    """
+    text = EXPORT_QUERIES[args.command]
+    if getattr(args, "over_quota", False):
+        text = "over_quota"
+    if getattr(args, "days", 0) and args.command == "expired":
+        text += f" and expired_days >= {int(args.days)}"
+    if getattr(args, "name", None):
+        quoted = re.sub(r'(["\\])', r"\\\1", args.name)
+        text += f' and email ~ "{quoted}"'
+    queries = [q for q in (text and CompiledQuery(text), args.where) if q]
+    usage = args.usage or args.command == "top" or any(q.needs_usage for q in queries)
+    users = iter_clients(args.inbound, usage=usage)
+    for query in queries:
+        users = query.stream(users)
+    if args.command == "top" and args.over_quota:
+        users = heapq.nlargest(args.limit, users, key=lambda c: c.up + c.down - c.total)
+    elif args.command == "top":
+        users = heapq.nlargest(args.limit, users, key=lambda c: c.up + c.down)
+    try:
+        with phase("render"):
+            export_users(users, args.export, args.output, usage)
+    except BrokenPipeError:
+        raise
+    except OSError as e:
+        print(f"❌ Export failed: {e}", file=sys.stderr)
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def cli_days(args):
+    days = args.days if args.action == "add" else -args.days
+    enabled = {"enabled": True, "disabled": False}.get(args.state)
+    try:
+        match = client_predicate(
+            args.name, args.regex, args.min_days_left, args.max_days_left, enabled
+        )
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return EXIT_USAGE
+    inbound_ids = [args.inbound] if args.inbound else None
+    if not args.dry_run and not confirm_cli(
+        args,
+        f"{'Add' if days > 0 else 'Remove'} {abs(days)} days for matching clients?",
+    ):
+        return EXIT_NOT_CONFIRMED
+    try:
+        changes = shift_expiry(days, inbound_ids, match, dry_run=args.dry_run)
+    except Exception as e:
+        print(f"❌ Failed to update clients: {e}")
+        return EXIT_FAILURE
+    if args.json:
+        print(json_dumps(changes))
+        return EXIT_OK
+    if args.dry_run and changes:
+        show_table(changes, status="expiry_shift", fmt=args.format, paged=False)
+    print_shift_summary(changes, days, args.dry_run)
+    return EXIT_OK
+
+
+def cli_users(args):
+    if not args.where and args.action != "list":
+        print("❌ --where is required to change users.", file=sys.stderr)
+        return EXIT_USAGE
+    users = filter_users(get_snapshot().select(args.inbound), args.where)
+    if args.action == "list":
+        print_users(users, "query", args)
+        return EXIT_OK
+    if not users:
+        print("No matching users found.")
+        return EXIT_OK
+    verb = {"delete": "Delete", "disable": "Disable", "enable": "Enable"}[args.action]
+    if not confirm_cli(args, f"{verb} {len(users)} matching users?"):
+        return EXIT_NOT_CONFIRMED
+    if args.action == "delete":
+        return EXIT_OK if delete_users(users) is not None else EXIT_FAILURE
+    try:
+        changed = set_users_enabled(users, args.action == "enable")
+    except Exception as e:
+        print(f"❌ Failed to {args.action} users: {e}")
+        return EXIT_FAILURE
+    print(f"{verb}d {changed} users.")
+    return EXIT_OK
+
+
+def cli_watch(args):
+    if not (
+        args.delete_expired is not None
+        or args.disable_over_quota
+        or args.enable_not_started
+    ):
+        print(
+            "❌ Choose at least one policy: --delete-expired DAYS, "
+            "--disable-over-quota or --enable-not-started.",
+            file=sys.stderr,
+        )
+        return EXIT_USAGE
+    watcher = Watcher(
+        delete_expired=args.delete_expired,
+        disable_over_quota=args.disable_over_quota,
+        enable_not_started=args.enable_not_started,
+        where=args.where,
+        dry_run=args.dry_run,
+    )
+    watch(watcher, interval=args.interval, once=args.once)
+    return EXIT_OK
+
+
+def cli_reconcile(args):
+    report = reconcile()
+    if args.json and args.action == "report":
+        print(json_dumps(report))
+        return EXIT_OK
+    print_reconcile_report(report)
+    if args.action == "report":
+        return EXIT_OK
+    todo = len(report["orphan_traffic"]) + len(report["missing_traffic"])
+    if args.dedupe:
+        todo += len(report["duplicates"])
+    if not todo:
+        print("Nothing to repair.")
+        return EXIT_OK
+    if not confirm_cli(args, "Repair these inconsistencies?"):
+        return EXIT_NOT_CONFIRMED
+    try:
+        result = repair(report, dedupe=args.dedupe)
+    except Exception as e:
+        print(f"❌ Repair failed: {e}")
+        return EXIT_FAILURE
+    print_repair_result(result)
+    return EXIT_OK
+
+
+def cli_index(args):
+    db = get_db()
+    if db.index is None:
+        db.index = ClientIndex(db)
+    started = time.perf_counter()
+    changed = db.index.refresh(force=args.action == "rebuild")
+    if args.action == "rebuild":
+        print(
+            f"✅ Indexed {changed} inbounds in "
+            f"{time.perf_counter() - started:.2f}s ({db.index.path})"
+        )
+        return EXIT_OK
+    if not args.key:
+        print("❌ find needs an EMAIL or client id.", file=sys.stderr)
+        return EXIT_USAGE
+    rows = db.index.find(args.key)
+    for email, client_id, inbound_id, position in rows:
+        print(f"{email}: inbound {inbound_id}, position {position}, id {client_id}")
+    if not rows:
+        print(f"No client with email or id {args.key} found.")
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def cli_backup(args):
+    try:
+        if args.action == "create":
+            create_backup(args.label)
+        elif args.action == "list":
+            backups = list_backups()
+            if args.json:
+                keys = ("path", "size", "mtime")
+                print(json_dumps([dict(zip(keys, b)) for b in backups]))
+            else:
+                show_table(backups, status="backups", fmt=args.format, paged=False)
+        else:
+            if not args.file:
+                print("❌ restore needs a backup FILE.", file=sys.stderr)
+                return EXIT_USAGE
+            if not confirm_cli(args, f"Replace {current_db_path()} with {args.file}?"):
+                return EXIT_NOT_CONFIRMED
+            restore_backup(args.file)
+    except Exception as e:
+        print(f"❌ Backup {args.action} failed: {e}")
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def cli_compact(args):
+    try:
+        result = compact_database(vacuum=not args.checkpoint_only)
+    except Exception as e:
+        print(f"❌ Compaction failed: {e}")
+        return EXIT_FAILURE
+    if args.json:
+        print(json_dumps(result))
+    return EXIT_OK
+
+
+def cli_traffic(args):
+    try:
+        if args.action == "import":
+            records = list(read_traffic_file(args.target, args.unit))
+        else:
+            records = [(args.target, int(args.down * GB), int(args.up * GB))]
+        if not confirm_cli(args, f"Set traffic of {len(records)} clients?"):
+            return EXIT_NOT_CONFIRMED
+        summary = import_traffic(records)
+    except Exception as e:
+        print(f"❌ Failed to update traffic: {e}")
+        return EXIT_FAILURE
+    print_traffic_summary(summary)
+    return EXIT_FAILURE if summary["missing"] else EXIT_OK
+
+
+def build_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="xuim",
+        description="X-UI Management Tool. Run without a command for the menu.",
+    )
+    parser.add_argument("--version", action="version", version=__version__)
+    parser.add_argument("--db", help=f"path to x-ui.db (default: {DB_PATH})")
+    parser.add_argument(
+        "--debug", action="store_true", help="print debug output (XUIM_DEBUG)"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print time per phase and scan counters after each action",
+    )
+    parser.add_argument("--trace-file", help="append one JSON line per action")
+    parser.add_argument("--cprofile", help="dump cProfile stats of the action")
+    parser.add_argument(
+        "--read-only",
+        action="store_true",
+        help="never write to the database (XUIM_READ_ONLY)",
+    )
+    parser.add_argument(
+        "--fleet",
+        action="append",
+        metavar="PATHS",
+        help="run against many databases: comma-separated paths or globs",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="fleet workers (default: XUIM_WORKERS or 4)"
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="fleet workers are processes instead of threads",
+    )
+    parser.add_argument(
+        "--backup",
+        action="store_true",
+        help="back up the database before every change (XUIM_AUTO_BACKUP)",
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    def add_list_args(p, name=True, days=False, where=True, yes=True):
+        p.add_argument("--inbound", type=int, help="only this inbound id")
+        if where:
+            p.add_argument(
+                "--where", metavar="EXPR", help="filter expression (see: xuim users -h)"
+            )
+        if name:
+            p.add_argument("--name", help="only emails containing this substring")
+        if days:
+            p.add_argument(
+                "--days", type=int, default=0, help="expired at least this many days"
+            )
+        p.add_argument("--json", action="store_true", help="print JSON")
+        if where:
+            p.add_argument(
+                "--usage", action="store_true", help="add up/down/all-time traffic"
+            )
+            p.add_argument(
+                "--export",
+                choices=["csv", "jsonl"],
+                help="stream the list as CSV or JSON Lines",
+            )
+            p.add_argument(
+                "--output", metavar="FILE", help="export to FILE (default: stdout)"
+            )
+        p.add_argument(
+            "--format",
+            choices=["grid", "plain", "tsv"],
+            help="table style (default: grid)",
+        )
+        if yes:
+            p.add_argument("--yes", action="store_true", help="do not ask to confirm")
+
+    p = commands.add_parser("expired", help="expired users")
+    p.add_argument("action", choices=["list", "delete"])
+    add_list_args(p, days=True)
+    p.set_defaults(func=cli_expired)
+
+    p = commands.add_parser("not-started", help="users that start after first use")
+    p.add_argument("action", choices=["list", "delete"])
+    add_list_args(p)
+    p.set_defaults(func=cli_not_started)
+
+    p = commands.add_parser("unlimited", help="users without an expiry")
+    p.add_argument("action", choices=["list"])
+    add_list_args(p, name=False, yes=False)
+    p.set_defaults(func=cli_unlimited)
+
+    p = commands.add_parser("inactive", help="disabled users")
+    p.add_argument("action", choices=["list", "enable"])
+    add_list_args(p, name=False)
+    p.set_defaults(func=cli_inactive)
+
+    p = commands.add_parser("over-quota", help="users that used up their traffic")
+    p.add_argument("action", choices=["list", "disable"])
+    add_list_args(p, name=False)
+    p.set_defaults(func=cli_over_quota)
+
+    p = commands.add_parser("top", help="heaviest traffic users")
+    p.add_argument("limit", type=int, nargs="?", default=10, help="default: 10")
+    p.add_argument(
+        "--over-quota",
+        action="store_true",
+        help="only users past their quota, ranked by overuse",
+    )
+    add_list_args(p, name=False, yes=False)
+    p.set_defaults(func=cli_top)
+
+    p = commands.add_parser("days", help="give or remove days")
+    p.add_argument("action", choices=["add", "sub"])
+    p.add_argument("days", type=int)
+    p.add_argument("--regex", help="only emails matching this regex")
+    p.add_argument("--min-days-left", type=int, help="only clients with >= N days left")
+    p.add_argument("--max-days-left", type=int, help="only clients with <= N days left")
+    p.add_argument("--state", choices=["enabled", "disabled"], help="only this state")
+    p.add_argument("--dry-run", action="store_true", help="show changes, write nothing")
+    add_list_args(p, where=False)
+    p.set_defaults(func=cli_days)
+
+    p = commands.add_parser(
+        "users",
+        help="list or change users matching a filter expression",
+        description=QUERY_HELP,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument("action", choices=["list", "delete", "disable", "enable"])
+    add_list_args(p, name=False)
+    p.set_defaults(func=cli_users)
+
+    p = commands.add_parser("watch", help="apply cleanup policies continuously")
+    p.add_argument(
+        "--delete-expired",
+        type=int,
+        metavar="DAYS",
+        help="delete users expired at least DAYS days",
+    )
+    p.add_argument(
+        "--disable-over-quota", action="store_true", help="disable over-quota users"
+    )
+    p.add_argument(
+        "--enable-not-started",
+        action="store_true",
+        help="enable disabled users that have not started yet",
+    )
+    p.add_argument(
+        "--where", metavar="EXPR", help="only users matching this filter expression"
+    )
+    p.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="seconds between checks (default: 60)",
+    )
+    p.add_argument("--once", action="store_true", help="run one cycle and exit")
+    p.add_argument("--dry-run", action="store_true", help="log actions, change nothing")
+    p.set_defaults(func=cli_watch)
+
+    p = commands.add_parser(
+        "reconcile", help="find or repair clients and traffic rows out of sync"
+    )
+    p.add_argument("action", choices=["report", "repair"])
+    p.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="also remove all but the first client of a duplicated email",
+    )
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    p.add_argument("--yes", action="store_true", help="do not ask to confirm")
+    p.set_defaults(func=cli_reconcile)
+
+    p = commands.add_parser("index", help="find a client or rebuild the client index")
+    p.add_argument("action", choices=["find", "rebuild"])
+    p.add_argument("key", nargs="?", metavar="EMAIL|ID")
+    p.set_defaults(func=cli_index)
+
+    p = commands.add_parser("backup", help="create, list or restore backups")
+    p.add_argument("action", choices=["create", "list", "restore"])
+    p.add_argument("file", nargs="?", help="backup to restore (path or file name)")
+    p.add_argument("--label", default="manual", help="name part of a new backup")
+    p.add_argument("--json", action="store_true", help="print JSON")
+    p.add_argument(
+        "--format",
+        choices=["grid", "plain", "tsv"],
+        help="table style (default: grid)",
+    )
+    p.add_argument("--yes", action="store_true", help="do not ask to confirm")
+    p.set_defaults(func=cli_backup)
+
+    p = commands.add_parser(
+        "compact", help="checkpoint the WAL and VACUUM, report reclaimed space"
+    )
+    p.add_argument(
+        "--checkpoint-only",
+        action="store_true",
+        help="only truncate the WAL, skip VACUUM",
+    )
+    p.add_argument("--json", action="store_true", help="also print the result as JSON")
+    p.set_defaults(func=cli_compact)
+
+    p = commands.add_parser("traffic", help="set or bulk-import client traffic")
+    p.add_argument("action", choices=["set", "import"])
+    p.add_argument("target", metavar="EMAIL|FILE")
+    p.add_argument("--down", type=float, default=0, help="download in GB (set)")
+    p.add_argument("--up", type=float, default=0, help="upload in GB (set)")
+    p.add_argument(
+        "--unit",
+        choices=["gb", "bytes"],
+        default="gb",
+        help="unit of values in the import file (default: gb)",
+    )
+    p.add_argument("--yes", action="store_true", help="do not ask to confirm")
+    p.set_defaults(func=cli_traffic)
+
+    return parser
+
+
+# ------------------------- Fleet ------------------------- #
+class ThreadOutput:
+    """
+    Stand-in for sys.stdout/stderr: text written by a fleet worker thread
+    goes to that thread's buffer, everything else to the real stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _target(self):
+        return getattr(_local, "output", None) or self.stream
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return getattr(_local, "output", None) is None and self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def fleet_paths(specs):
+    """Database paths from comma-separated paths and glob patterns, in order."""
+    import glob
+
+    paths = []
+    for spec in specs:
+        for item in filter(None, (s.strip() for s in spec.split(","))):
+            matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+            for path in matches:
+                if os.path.abspath(path) not in map(os.path.abspath, paths):
+                    paths.append(path)
+    return paths
+
+
+def run_fleet_member(argv, path):
+    """
+    Run one command against one database of a fleet, in a worker thread or
+    process. Returns (path, exit code, printed text, collected user lists,
+    seconds); a failure only affects this database.
+    """
+    import io
+
+    started = time.perf_counter()
+    if not isinstance(sys.stdout, ThreadOutput):
+        # First task of a worker process.
+        sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+    _local.db_path = path
+    _local.output = io.StringIO()
+    _local.collect = []
+    try:
+        args = build_parser().parse_args(argv)
+        apply_global_args(args)
+        rc = prepare_args(args)
+        if rc is None:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"no such database: {path}")
+            rc = dispatch(args)
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else EXIT_FAILURE
+    except Exception as e:
+        print(f"❌ {type(e).__name__}: {e}", file=_local.output)
+        rc = EXIT_FAILURE
+    finally:
+        db = _databases.pop(path, None)
+        if db is not None:
+            db.close()
+        output, collected = _local.output.getvalue(), _local.collect
+        _local.db_path = _local.output = _local.collect = None
+    return path, rc, output, collected, time.perf_counter() - started
+
+
+def run_fleet(args, argv):
+    """
+    Run the command against every database of --fleet in a thread pool (or
+    a process pool with --processes) and print one merged result tagged by
+    database, followed by the time and status of each database.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    paths = fleet_paths(args.fleet)
+    if not paths:
+        print("❌ --fleet matched no databases.", file=sys.stderr)
+        return EXIT_USAGE
+    if args.command == "watch" or getattr(args, "export", None):
+        print(
+            "❌ watch and --export run against a single database "
+            "(use --json to merge a fleet).",
+            file=sys.stderr,
+        )
+        return EXIT_USAGE
+    workers = max(1, min(args.workers or FLEET_WORKERS, len(paths)))
+    pool = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    if not args.processes:
+        sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+    try:
+        with pool(max_workers=workers) as executor:
+            results = list(executor.map(run_fleet_member, [argv] * len(paths), paths))
+    finally:
+        if not args.processes:
+            sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+
+    as_json = getattr(args, "json", False)
+    # With --json, stdout only carries the merged JSON.
+    log = sys.stderr if as_json else sys.stdout
+    tagged, status = [], None
+    for path, rc, output, collected, seconds in results:
+        for status, users in collected:
+            tagged.extend((path, u) for u in users)
+        if output.strip():
+            print(f"── {path} ──\n{output.rstrip()}", file=log)
+    if status is not None:
+        if as_json:
+            loaded = usage_loaded(status, args)
+            print(json_dumps([dict(u.as_dict(loaded), db=path) for path, u in tagged]))
+        else:
+            usage = getattr(args, "usage", False) or None
+            show_table(
+                tagged, status, fmt=args.format, paged=False, usage=usage, tagged=True
+            )
+
+    print(f"\nFleet: {len(paths)} databases, {workers} workers", file=log)
+    for path, rc, output, collected, seconds in results:
+        rows = sum(len(users) for _, users in collected)
+        state = "ok" if rc == EXIT_OK else f"exit {rc}"
+        print(f"  {path}: {state}, {rows} rows, {seconds:.2f}s", file=log)
+    return max(rc for _, rc, _, _, _ in results)
+
+
+def apply_global_args(args):
+    global DB_PATH, DEBUG, TRACE_SUMMARY, TRACE_FILE, CPROFILE_FILE, AUTO_BACKUP
+    global READ_ONLY
+    if args.db:
+        DB_PATH = args.db
+    if args.debug:
+        DEBUG = True
+    if args.profile:
+        TRACE_SUMMARY = True
+    if args.trace_file:
+        TRACE_FILE = args.trace_file
+    if args.cprofile:
+        CPROFILE_FILE = args.cprofile
+    if args.backup:
+        AUTO_BACKUP = True
+    if args.read_only:
+        READ_ONLY = True
+
+
+def prepare_args(args):
+    """Compile --where; returns an exit code when the arguments are invalid."""
+    if hasattr(args, "where"):
+        try:
+            args.where = CompiledQuery(args.where) if args.where else None
+        except ValueError as e:
+            print(f"❌ Invalid --where: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    return None
+
+
+def dispatch(args):
+    if getattr(args, "export", None) and getattr(args, "action", "list") == "list":
+        return cli_export(args)
+    return args.func(args)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    apply_global_args(args)
+    if not args.command:
+        main_menu()
+        return EXIT_OK
+    if args.fleet:
+        with traced(f"fleet {args.command} {getattr(args, 'action', '')}".strip()):
+            return run_fleet(args, sys.argv[1:] if argv is None else argv)
+    rc = prepare_args(args)
+    if rc is not None:
+        return rc
+    try:
+        with traced(f"{args.command} {getattr(args, 'action', '')}".strip()):
+            return dispatch(args)
+    except BrokenPipeError:
+        # Output piped into head/grep that exited early.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return EXIT_OK
+
+
 if __name__ == "__main__":
-    main_menu()
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""
+Benchmarks for xuim.py against synthetic x-ui databases.
+
+    python3 xuim_bench.py                                # 1k, 10k, 100k, 500k clients
+    python3 xuim_bench.py --sizes 1000,10000 --save bench.json
+    python3 xuim_bench.py --sizes 1000,10000 --compare bench.json
+
+Each operation runs in a fresh interpreter on a fresh copy of the
+database, so wall time, peak RSS and write-lock hold time are measured
+per operation.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import xuim  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+DAY_MS = 24 * 3600 * 1000
+
+INBOUNDS_SQL = """
+CREATE TABLE inbounds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER, up INTEGER, down INTEGER, total INTEGER,
+    remark TEXT, enable NUMERIC, expiry_time INTEGER, listen TEXT,
+    port INTEGER UNIQUE, protocol TEXT, settings TEXT,
+    stream_settings TEXT, tag TEXT UNIQUE, sniffing TEXT
+)
+"""
+CLIENT_TRAFFICS_SQL = """
+CREATE TABLE client_traffics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    inbound_id INTEGER, enable NUMERIC, email TEXT UNIQUE,
+    up INTEGER, down INTEGER, all_time INTEGER, expiry_time INTEGER,
+    total INTEGER, reset INTEGER DEFAULT 0, last_online INTEGER DEFAULT 0
+)
+"""
+
+
+# ------------------------- Synthetic Database ------------------------- #
+def make_db(
+    path,
+    clients,
+    inbounds=10,
+    pad=0,
+    expired=0.3,
+    not_started=0.1,
+    unlimited=0.1,
+    inactive=0.1,
+    seed=1,
+):
+    """
+    Write a synthetic x-ui.db with `clients` clients spread over `inbounds`
+    inbounds. The expiry mix is given as fractions; the rest expire in the
+    future. `pad` adds that many bytes per client to grow the blobs.
+    """
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(INBOUNDS_SQL)
+    conn.execute(CLIENT_TRAFFICS_SQL)
+
+    per_inbound = max(clients // inbounds, 1)
+    made = 0
+    for i in range(inbounds):
+        count = per_inbound if i < inbounds - 1 else clients - made
+        client_list, traffic = [], []
+        for j in range(count):
+            r = rng.random()
+            if r < expired:
+                expiry = now_ms - rng.randint(1, 120) * DAY_MS
+            elif r < expired + not_started:
+                expiry = -rng.randint(1, 30) * DAY_MS
+            elif r < expired + not_started + unlimited:
+                expiry = 0
+            else:
+                expiry = now_ms + rng.randint(1, 90) * DAY_MS
+            email = f"user{i}-{j}" + ("-trial" if j % 7 == 0 else "")
+            enable = rng.random() >= inactive
+            client_list.append(
+                {
+                    "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                    "flow": "",
+                    "email": email,
+                    "limitIp": 0,
+                    "totalGB": 50 * xuim.GB if j % 3 == 0 else 0,
+                    "expiryTime": expiry,
+                    "enable": enable,
+                    "tgId": "",
+                    "subId": f"{i:04x}{j:012x}",
+                    "comment": "x" * pad,
+                    "reset": 0,
+                }
+            )
+            traffic.append(
+                (
+                    i + 1,
+                    enable,
+                    email,
+                    rng.randint(0, 40 * xuim.GB),
+                    rng.randint(0, 40 * xuim.GB),
+                    0,
+                    expiry,
+                    0,
+                )
+            )
+        made += count
+        settings = {"clients": client_list, "decryption": "none", "fallbacks": []}
+        conn.execute(
+            "INSERT INTO inbounds (user_id, up, down, total, remark, enable, "
+            "expiry_time, listen, port, protocol, settings, stream_settings, "
+            "tag, sniffing) VALUES (1, 0, 0, 0, ?, 1, 0, '', ?, 'vless', ?, "
+            "'{}', ?, '{}')",
+            (f"inbound-{i}", 20000 + i, json.dumps(settings, indent=2), f"in-{i}"),
+        )
+        conn.executemany(
+            "INSERT INTO client_traffics (inbound_id, enable, email, up, down, "
+            "all_time, expiry_time, total) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            traffic,
+        )
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+# ------------------------- Operations ------------------------- #
+def prepare_none():
+    return None
+
+
+def prepare_expired():
+    return xuim.get_expired_users()
+
+
+def prepare_traffic():
+    return [(c.email, 5 * xuim.GB, xuim.GB) for c in xuim.get_snapshot().clients[::10]]
+
+
+# name: (mutates, prepare, run). prepare is not timed.
+OPERATIONS = {
+    "get_expired_users": (False, prepare_none, lambda _: xuim.get_expired_users()),
+    "get_not_started_users": (
+        False,
+        prepare_none,
+        lambda _: xuim.get_not_started_users(),
+    ),
+    "get_unlimited_users": (False, prepare_none, lambda _: xuim.get_unlimited_users()),
+    "get_inactive_users": (False, prepare_none, lambda _: xuim.get_inactive_users()),
+    "get_over_quota_users": (
+        False,
+        prepare_none,
+        lambda _: xuim.get_over_quota_users(),
+    ),
+    "delete_users": (True, prepare_expired, lambda users: xuim.delete_users(users)),
+    "give_days_to_clients": (True, prepare_none, lambda _: xuim.shift_expiry(7)),
+    "import_traffic": (True, prepare_traffic, lambda recs: xuim.import_traffic(recs)),
+}
+
+
+def run_child(name, db_path):
+    """Run one operation in this process and print its measurements as JSON."""
+    xuim.DB_PATH = db_path
+    _, prepare, run = OPERATIONS[name]
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        arg = prepare()
+        if xuim.USE_INDEX:
+            # xuim keeps its index between runs; do not time a cold build.
+            xuim.get_index()
+        db = xuim.get_db()
+        db.total_lock_ms = 0.0
+        started = time.perf_counter()
+        run(arg)
+        wall = time.perf_counter() - started
+    finally:
+        sys.stdout = stdout
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "wall_s": round(wall, 4),
+                "peak_rss_mb": round(peak_kb / 1024, 1),
+                "lock_ms": round(db.total_lock_ms, 2),
+            }
+        )
+    )
+
+
+def measure(name, db_path, workdir):
+    mutates = OPERATIONS[name][0]
+    target = db_path
+    if mutates:
+        target = os.path.join(workdir, "mutate.db")
+        for stale in (target, target + "-wal", target + "-shm"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        shutil.copyfile(db_path, target)
+    # Keep the client index files out of the system cache directory.
+    env = dict(os.environ, XUIM_CACHE_DIR=os.path.join(workdir, "cache"))
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", name, target],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# ------------------------- Reporting ------------------------- #
+def print_results(results, baseline=None, threshold=0.2):
+    print(
+        f"{'clients':>8}  {'operation':<22} {'wall s':>9} {'peak MB':>8} "
+        f"{'lock ms':>9}  {'vs baseline':>11}"
+    )
+    for size, ops in results.items():
+        for name, r in ops.items():
+            if "error" in r:
+                print(f"{size:>8}  {name:<22} ERROR {r['error']}")
+                continue
+            versus = ""
+            base = (baseline or {}).get(size, {}).get(name)
+            if base and "wall_s" in base and base["wall_s"] > 0:
+                ratio = r["wall_s"] / base["wall_s"]
+                versus = f"{ratio:.2f}x" + (" !" if ratio > 1 + threshold else "")
+            print(
+                f"{size:>8}  {name:<22} {r['wall_s']:>9.4f} "
+                f"{r['peak_rss_mb']:>8.1f} {r['lock_ms']:>9.2f}  {versus:>11}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, DEFAULT_SIZES)),
+        help="comma separated total client counts",
+    )
+    parser.add_argument("--inbounds", type=int, default=10)
+    parser.add_argument("--pad", type=int, default=0, help="extra bytes per client")
+    parser.add_argument("--expired", type=float, default=0.3)
+    parser.add_argument("--not-started", type=float, default=0.1)
+    parser.add_argument("--unlimited", type=float, default=0.1)
+    parser.add_argument("--inactive", type=float, default=0.1)
+    parser.add_argument(
+        "--ops", help=f"comma separated subset of: {', '.join(OPERATIONS)}"
+    )
+    parser.add_argument("--save", help="write results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a saved JSON baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="flag operations slower than baseline by this fraction",
+    )
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(*args.child)
+        return 0
+
+    ops = args.ops.split(",") if args.ops else list(OPERATIONS)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="xuim-bench-") as workdir:
+        for size in sizes:
+            db_path = os.path.join(workdir, f"x-ui-{size}.db")
+            started = time.perf_counter()
+            make_db(
+                db_path,
+                size,
+                inbounds=args.inbounds,
+                pad=args.pad,
+                expired=args.expired,
+                not_started=args.not_started,
+                unlimited=args.unlimited,
+                inactive=args.inactive,
+            )
+            print(
+                f"generated {size} clients ({os.path.getsize(db_path) / 1e6:.1f} MB) "
+                f"in {time.perf_counter() - started:.1f}s",
+                file=sys.stderr,
+            )
+            results[str(size)] = {name: measure(name, db_path, workdir) for name in ops}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "version": xuim.__version__,
+                    "python": sys.version.split()[0],
+                    "sqlite": sqlite3.sqlite_version,
+                    "created": int(time.time()),
+                    "args": {k: v for k, v in vars(args).items() if k != "child"},
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())